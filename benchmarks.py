@@ -0,0 +1,228 @@
+"""Benchmarks of xml_orm operations.
+
+Run with: python benchmarks.py [--tiers 1000 10000 ...] [--output results.json]
+Every benchmark uses temporary database, so XML-database.db is not touched."""
+import argparse, asyncio, datetime, json, os, platform, sqlite3, tempfile, threading, time, tracemalloc
+from xml.etree import ElementTree
+import xml_import, xml_orm, xml_orm_async
+
+
+def generate_xml(fan_out, depth, attributes=1, text_size=5):
+    """Returns xml document where every node has fan_out children up to given depth. Every
+    node below the root has given number of attributes and text of text_size characters."""
+    root = ElementTree.Element('root')
+    level = [root]
+    text = ('value' * (text_size // 5 + 1))[:text_size]
+    for i in range(depth):
+        level = [ElementTree.SubElement(parent, f'node{i}', id=str(j)) for parent in level for j in range(fan_out)]
+        for node in level:
+            for k in range(1, attributes):
+                node.set(f'attr{k}', f'value{k}')
+            if text:
+                node.text = text
+    return ElementTree.tostring(root, encoding='unicode')
+
+
+def tier_shape(nodes, fan_out=10):
+    """Returns (fan_out, depth) of the smallest generated document with at least given nodes."""
+    depth, count = 0, 1
+    while count < nodes:
+        depth += 1
+        count += fan_out ** depth
+    return fan_out, depth
+
+
+_directory = None
+
+
+def temporary_database():
+    """Points xml_orm to empty database in temporary directory and returns its path, the
+    database of the previous call is removed."""
+    global _directory
+    remove_temporary_database()
+    _directory = tempfile.TemporaryDirectory()
+    path = os.path.join(_directory.name, 'benchmark.db')
+    xml_orm.configure(url=f'sqlite:///{path}')
+    xml_orm.get_engine() # creates tables outside of measured calls
+    return path
+
+
+def remove_temporary_database():
+    """Closes connections of the last temporary database and removes its directory."""
+    global _directory
+    if _directory is not None:
+        xml_orm.get_engine().dispose()
+        _directory.cleanup()
+        _directory = None
+
+
+def bench_load_xml():
+    """Shows that number of queries issued by load_xml does not depend on document size."""
+    print(f"{'nodes':>8} {'statements':>10} {'seconds':>8}")
+    for fan_out, depth in ((3, 3), (5, 4), (10, 4), (20, 4)):
+        temporary_database()
+        xml_orm.save_xml(generate_xml(fan_out, depth))
+        root_id = xml_orm.available_xml()[0].node_id
+        nodes = sum(fan_out ** level for level in range(depth + 1))
+        with xml_orm.query_budget() as counters:
+            started = time.perf_counter()
+            xml_orm.load_xml(root_id)
+            seconds = time.perf_counter() - started
+        print(f"{nodes:>8} {counters['statements']:>10} {seconds:>8.3f}")
+
+
+def bench_async(requests=200, concurrency=(1, 10, 50)):
+    """Compares requests per second of load_xml called by threads of sync API and by
+    concurrent coroutines of async API, in both cases another thread or coroutine keeps adding
+    subtrees."""
+    temporary_database()
+    root_id = xml_orm.save_xml(generate_xml(5, 3))
+
+    def run_sync(workers):
+        def reader():
+            for _ in range(requests // workers):
+                xml_orm.load_xml(root_id)
+        def writer():
+            for _ in range(10):
+                xml_orm.add_sub_xml(root_id, 1, '<added>value</added>')
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(workers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return requests // workers * workers / (time.perf_counter() - started)
+
+    async def run(workers):
+        async def reader():
+            for _ in range(requests // workers):
+                await xml_orm_async.load_xml(root_id)
+        async def writer():
+            for _ in range(10):
+                await xml_orm_async.add_sub_xml(root_id, 1, '<added>value</added>')
+        started = time.perf_counter()
+        await asyncio.gather(writer(), *[reader() for _ in range(workers)])
+        seconds = time.perf_counter() - started
+        await xml_orm_async.dispose()
+        return requests // workers * workers / seconds
+
+    print(f"{'api':>12} {'requests/s':>12}")
+    for workers in concurrency:
+        print(f"{f'sync x{workers}':>12} {run_sync(workers):>12.1f}")
+        print(f"{f'async x{workers}':>12} {asyncio.run(run(workers)):>12.1f}")
+
+
+def database_size(path):
+    """Returns size of the database file in bytes, connections are closed first, so the
+    WAL journal is written into the file."""
+    xml_orm.get_engine().dispose()
+    return os.path.getsize(path)
+
+
+def bench_storage(nodes=100000, attributes=3, text_size=100, compress_text=(None, 64)):
+    """Shows database size and load_xml time of generated document, texts are stored plain
+    and compressed."""
+    fan_out, depth = tier_shape(nodes)
+    xml = generate_xml(fan_out, depth, attributes, text_size)
+    print(f"{'compress_text':>14} {'size MiB':>9} {'load s':>8}")
+    for threshold in compress_text:
+        path = temporary_database()
+        xml_orm.configure(compress_text=threshold)
+        root_id = xml_orm.save_xml(xml)
+        size = database_size(path)
+        started = time.perf_counter()
+        xml_orm.load_xml(root_id)
+        print(f"{str(threshold):>14} {size / 2**20:>9.1f} {time.perf_counter() - started:>8.2f}")
+    xml_orm.configure(compress_text=None)
+
+
+def bench_import(files=200, nodes=1000, workers=(1, 2, 4)):
+    """Shows throughput of xml_import.import_directory with different number of parsing
+    processes, it can grow only up to the number of CPUs and the speed of the writer."""
+    xml = generate_xml(*tier_shape(nodes), attributes=3, text_size=20)
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(files):
+            with open(os.path.join(directory, f'{i}.xml'), 'w') as file:
+                file.write(xml)
+        print(f"{'workers':>8} {'files/s':>9} {'rows/s':>10}")
+        for count in workers:
+            temporary_database()
+            result = xml_import.import_directory(directory, workers=count)
+            print(f"{count:>8} {files / result['seconds']:>9.1f} {result['rows'] / result['seconds']:>10.0f}")
+
+
+def measure(operation, *args):
+    """Calls operation and returns (result, statistics), statistics contain seconds, counters
+    of xml_orm.query_budget and peak_memory, the largest amount of memory allocated by python
+    during the call in bytes."""
+    tracemalloc.start()
+    try:
+        with xml_orm.query_budget() as counters:
+            started = time.perf_counter()
+            result = operation(*args)
+            seconds = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, {'seconds': seconds, **counters, 'peak_memory': peak}
+
+
+def bench_suite(tiers=(1000, 10000, 100000), attributes=1, text_size=5):
+    """Times public operations on synthetic documents of given sizes, returns list of results.
+    Peak memory is traced by tracemalloc, which slows the measured calls down."""
+    results = []
+    for tier in tiers:
+        fan_out, depth = tier_shape(tier)
+        nodes = sum(fan_out ** level for level in range(depth + 1))
+        xml = generate_xml(fan_out, depth, attributes, text_size)
+        temporary_database()
+        last_line = nodes
+
+        def record(name, operation, *args):
+            result, stats = measure(operation, *args)
+            results.append({'tier': tier, 'nodes': nodes, 'operation': name, **stats})
+            print(f"{nodes:>8} {name:>22} {stats['seconds']:>9.3f} {stats['statements']:>10} {stats['peak_memory'] // 1024:>10}")
+            return result
+
+        root_id = record('save_xml', xml_orm.save_xml, xml)
+        record('load_xml', xml_orm.load_xml, root_id)
+        record('get_id_by_line_number', xml_orm.get_id_by_line_number, last_line, root_id)
+        record('update_node_value', xml_orm.update_node_value, root_id, last_line, 'id=changed')
+        record('add_sub_xml', xml_orm.add_sub_xml, root_id, 2, '<added id="new">value</added>')
+        record('change_node_order', xml_orm.change_node_order, root_id, 2, fan_out)
+        record('find_node_with_value', xml_orm.find_node_with_value, root_id, 'changed')
+        record('delete_xml', xml_orm.delete_xml, root_id)
+    return results
+
+
+def save_results(results, output):
+    """Writes results with description of the environment into json file."""
+    with open(output, 'w') as file:
+        json.dump({
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'settings': {key: value for key, value in xml_orm._settings.items() if key != 'url'},
+            'results': results,
+        }, file, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiers', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='document sizes in nodes, up to 1000000')
+    parser.add_argument('--attributes', type=int, default=1, help='attributes of every node')
+    parser.add_argument('--text-size', type=int, default=5, help='text length of every node')
+    parser.add_argument('--output', default='benchmark-results.json', help='json results file')
+    parser.add_argument('--all', action='store_true', help='run also load_xml, async, storage and import benchmarks')
+    arguments = parser.parse_args()
+    try:
+        if arguments.all:
+            bench_load_xml()
+            bench_async()
+            bench_storage()
+            bench_import()
+        print(f"{'nodes':>8} {'operation':>22} {'seconds':>9} {'statements':>10} {'peak KiB':>10}")
+        save_results(bench_suite(arguments.tiers, arguments.attributes, arguments.text_size), arguments.output)
+    finally:
+        remove_temporary_database()
@@ -1,6 +1,11 @@
 import sys
-from PyQt6.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout, QListWidget, QMessageBox, QPushButton, QDialog, QFileDialog, QHBoxLayout, QTextEdit, QListWidgetItem
-import xml_orm, re
+from PyQt6.QtWidgets import QApplication, QWidget, QLabel, QVBoxLayout, QListWidget, QMessageBox, QPushButton, QDialog, QFileDialog, QHBoxLayout, QTextEdit, QListWidgetItem, QTreeView
+from PyQt6.QtCore import Qt, QAbstractItemModel, QModelIndex, QObject, QThread, pyqtSignal, pyqtSlot
+import xml_orm, os
+
+EDITABLE_FILE_SIZE = 10 * 1024 * 1024 # bigger files are saved directly without the editor
+SEARCH_RESULTS = 100 # number of shown search results
+TREE_PAGE_SIZE = 200 # number of children loaded at once in the tree view
 
 class MyWindow(QWidget):
     def __init__(self):
@@ -73,10 +78,19 @@ class MyWindow(QWidget):
             file_path = None
 
         if file_path:
-            with open(file_path, "r") as file:
-                xml_content = file.read()
-            dialog = XMLEditorInterface(xml_content, [('Zapisz', 'save')], self)
-            dialog.exec()
+            if os.path.getsize(file_path) > EDITABLE_FILE_SIZE:
+                try:
+                    xml_orm.save_xml_file(file_path)
+                except xml_orm.ElementTree.ParseError:
+                    dlg = QMessageBox(self)
+                    dlg.setWindowTitle("Validation")
+                    dlg.setText("Xml validation has failed")
+                    button = dlg.exec()
+            else:
+                with open(file_path, "r") as file:
+                    xml_content = file.read()
+                dialog = XMLEditorInterface(xml_content, [('Zapisz', 'save')], self)
+                dialog.exec()
             self.load_xml_roots()
 
 
@@ -96,21 +110,21 @@ class MyWindow(QWidget):
         selected_value = self.xml_list.currentRow()
         if selected_value:
             dialog = XMLModifyInterface(int(self.xml_list.currentItem().whatsThis()), xml_orm.update_node_value,
-                'Wpisz klucz=nowa wartość, aby zmienić wartość w zaznczonej lini.\nW celu zmiany tekstu wpisz jako klucz - __text__', 'Zamień', self)
+                'Wpisz klucz=nowa wartość, aby zmienić wartość w zaznczonej lini.\nW celu zmiany tekstu wpisz jako klucz - __text__', 'Zamień', 'node', self)
             dialog.exec()
 
     def add_node(self):
         selected_value = self.xml_list.currentRow()
         if selected_value:
             dialog = XMLModifyInterface(int(self.xml_list.currentItem().whatsThis()), xml_orm.add_sub_xml,
-                'Dodaj nowy węzeł lub strukture węzłów', 'Wstaw', self)
+                'Dodaj nowy węzeł lub strukture węzłów', 'Wstaw', 'children', self)
             dialog.exec()
 
     def change_order(self):
         selected_value = self.xml_list.currentRow()
         if selected_value:
             dialog = XMLModifyInterface(int(self.xml_list.currentItem().whatsThis()), xml_orm.change_node_order,
-                'Wpisz numer pozycji, na której ma się znależć wybrany węzeł.', 'Zamień kolejność', self)
+                'Wpisz numer pozycji, na której ma się znależć wybrany węzeł.', 'Zamień kolejność', 'parent', self)
             dialog.exec()
 
     def find_value(self):
@@ -154,17 +168,179 @@ class XMLEditorInterface(XMLTextEditor):
             button = dlg.exec()
 
 
+class NodeItem:
+    """Node shown in the tree view, entry is the dictionary returned by xml_orm.load_node.
+    Children are loaded page by page, generation is increased when the node is refreshed,
+    so answers to older requests are ignored."""
+    def __init__(self, entry, parent=None, row=0):
+        self.entry = entry
+        self.parent = parent
+        self.row = row
+        self.children = []
+        self.complete = entry is not None and not entry['has_children']
+        self.loading = False
+        self.generation = 0
+
+    @property
+    def node_id(self):
+        return self.entry['node_id'] if self.entry else None
+
+    def label(self):
+        attributes = ''.join(f' {key}="{value}"' for key, value in self.entry['attributes'].items())
+        return f"<{self.entry['name']}{attributes}>{self.entry['text'] or ''}"
+
+
+class NodeLoader(QObject):
+    """Loads nodes from database in the worker thread and sends them back by signals."""
+    children_loaded = pyqtSignal(object, int, object, bool)
+    node_loaded = pyqtSignal(int, int, object)
+
+    def __init__(self, root_id):
+        super().__init__()
+        self.root_id = root_id
+
+    @pyqtSlot(object, int, int)
+    def load_children(self, node_id, generation, offset):
+        if node_id is None:
+            entries = [entry] if (entry := xml_orm.load_node(self.root_id)) else []
+        else:
+            entries = xml_orm.load_children(node_id, offset, TREE_PAGE_SIZE + 1)
+        self.children_loaded.emit(node_id, generation, entries[:TREE_PAGE_SIZE], len(entries) <= TREE_PAGE_SIZE)
+
+    @pyqtSlot(int, int)
+    def load_node(self, node_id, generation):
+        self.node_loaded.emit(node_id, generation, xml_orm.load_node(node_id))
+
+
+class XmlTreeModel(QAbstractItemModel):
+    """Tree of one xml document whose children are fetched when the view needs them
+    (canFetchMore/fetchMore). Queries run in the worker thread, refresh reloads one node
+    and optionally its children after the node was edited."""
+    children_requested = pyqtSignal(object, int, int)
+    node_requested = pyqtSignal(int, int)
+
+    def __init__(self, root_id, parent=None):
+        super().__init__(parent)
+        self.root = NodeItem(None)
+        self.items = {}
+        self.thread = QThread()
+        self.loader = NodeLoader(root_id)
+        self.loader.moveToThread(self.thread)
+        self.children_requested.connect(self.loader.load_children)
+        self.node_requested.connect(self.loader.load_node)
+        self.loader.children_loaded.connect(self.add_children)
+        self.loader.node_loaded.connect(self.update_node)
+        self.thread.start()
+
+    def close(self):
+        self.thread.quit()
+        self.thread.wait()
+
+    def item(self, index):
+        return index.internalPointer() if index.isValid() else self.root
+
+    def index_of(self, item):
+        return QModelIndex() if item is self.root else self.createIndex(item.row, 0, item)
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        return self.createIndex(row, column, self.item(parent).children[row])
+
+    def parent(self, index):
+        if not index.isValid():
+            return QModelIndex()
+        return self.index_of(index.internalPointer().parent)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.column() > 0 else len(self.item(parent).children)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if index.isValid() and role == Qt.ItemDataRole.DisplayRole:
+            return index.internalPointer().label()
+        return None
+
+    def hasChildren(self, parent=QModelIndex()):
+        item = self.item(parent)
+        return bool(item.children) or not item.complete
+
+    def canFetchMore(self, parent):
+        item = self.item(parent)
+        return not item.complete and not item.loading
+
+    def fetchMore(self, parent):
+        item = self.item(parent)
+        item.loading = True
+        self.children_requested.emit(item.node_id, item.generation, len(item.children))
+
+    def add_children(self, node_id, generation, entries, complete):
+        item = self.root if node_id is None else self.items.get(node_id)
+        if item is None or item.generation != generation:
+            return
+        if entries:
+            first = len(item.children)
+            self.beginInsertRows(self.index_of(item), first, first + len(entries) - 1)
+            for row, entry in enumerate(entries, first):
+                child = NodeItem(entry, item, row)
+                item.children.append(child)
+                self.items[child.node_id] = child
+            self.endInsertRows()
+        item.loading = False
+        item.complete = complete
+
+    def forget(self, item):
+        for child in item.children:
+            self.items.pop(child.node_id, None)
+            self.forget(child)
+
+    def refresh(self, node_id, children=True):
+        """Reloads the node in the worker thread, with children=True also its loaded children
+        are dropped and loaded again."""
+        item = self.items.get(node_id)
+        if item is None:
+            return
+        item.generation += 1
+        index = self.index_of(item)
+        if children:
+            loaded = bool(item.children) or item.loading
+            if item.children:
+                self.beginRemoveRows(index, 0, len(item.children) - 1)
+                self.forget(item)
+                item.children = []
+                self.endRemoveRows()
+            item.complete, item.loading = False, False
+            if loaded:
+                self.fetchMore(index)
+        self.node_requested.emit(node_id, item.generation)
+
+    def update_node(self, node_id, generation, entry):
+        item = self.items.get(node_id)
+        if item is None or item.generation != generation or entry is None:
+            return
+        item.entry = entry
+        if not entry['has_children'] and not item.children:
+            item.complete = True
+        index = self.index_of(item)
+        self.dataChanged.emit(index, index)
+
+
 class XMLModifyInterface(XMLTextEditor):
-    def __init__(self, id, func, info, text_button, parent=None):
+    def __init__(self, id, func, info, text_button, refresh='children', parent=None):
         super().__init__('', parent)
         self.setGeometry(100, 100, 400, 500)
         self.root_id = id
         self.func = func
+        self.refresh = refresh # edited part of the tree: 'node', 'children' or 'parent'
         self.xml_text_edit.setFixedHeight(100)
 
-        self.xml_list = QListWidget()
-        self.load_xml_doc()
-        self.layout.insertWidget(0, self.xml_list)
+        self.model = XmlTreeModel(self.root_id, self)
+        self.xml_tree = QTreeView()
+        self.xml_tree.setHeaderHidden(True)
+        self.xml_tree.setModel(self.model)
+        self.layout.insertWidget(0, self.xml_tree)
 
         info = QLabel(info)
         self.layout.insertWidget(1, info)
@@ -173,23 +349,21 @@ class XMLModifyInterface(XMLTextEditor):
         self.button1.clicked.connect(self.on_click)
         self.layout.addWidget(self.button1)
 
-    def load_xml_doc(self):
-        text = xml_orm.load_xml(self.root_id)
-
-        self.xml_list.clear()
-        self.xml_list.addItem("Wybierz węzeł")
-        lines_of_xml = re.sub(r">\n<(?!/)", ">><<", text[text.find('\n')+1:]).split('><')
-        for line in lines_of_xml:
-            self.xml_list.addItem(line)
-        self.xml_list.setCurrentRow(0)
+    def done(self, result):
+        self.model.close()
+        super().done(result)
 
     def on_click(self):
-        selected = self.xml_list.currentRow()
-        if selected:
+        selected = self.xml_tree.currentIndex()
+        if selected.isValid():
+            item = selected.internalPointer()
             try:
-                self.func(self.root_id, selected, self.xml_text_edit.toPlainText())
+                self.func(self.root_id, xml_orm.get_line_number(item.node_id), self.xml_text_edit.toPlainText())
                 self.xml_text_edit.clear()
-                self.load_xml_doc()
+                if self.refresh == 'parent' and item.parent.node_id is not None:
+                    self.model.refresh(item.parent.node_id)
+                else:
+                    self.model.refresh(item.node_id, children=self.refresh != 'node')
             except:
                 dlg = QMessageBox(self)
                 dlg.setWindowTitle("Walidacja")
@@ -214,7 +388,7 @@ class XMLSearchingInterface(XMLTextEditor):
         self.layout.addWidget(self.button1)
     
     def find_value(self):
-        if nodes := xml_orm.find_node_with_value(self.root_id, self.xml_text_edit.toPlainText()):
+        if nodes := xml_orm.find_node_with_value(self.root_id, self.xml_text_edit.toPlainText(), limit=SEARCH_RESULTS):
             self.found.setText('\nZnalezionio wartości:\n'+"\n".join(nodes))
             self.found.show()
 
@@ -0,0 +1,170 @@
+"""Import of many xml files into the database configured by xml_orm.configure.
+
+Files are parsed and flattened into rows by a pool of worker processes, the calling process
+is the only writer and saves every document by bulk inserts in its own transaction. Files
+which can not be read, parsed or saved are reported and skipped, the import goes on.
+
+Run with: python xml_import.py DIRECTORY [--workers N] [--pattern *.xml] [--url URL]
+"""
+import argparse, collections, concurrent.futures, contextlib, logging, os, pathlib, sys, time
+from xml.etree import ElementTree
+from sqlalchemy.orm import Session
+import xml_orm
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker(settings):
+    """This is internal function which copies settings of xml_orm into worker process, they
+    decide how texts are stored."""
+    xml_orm._settings.update(settings)
+
+def _error(error):
+    """This is internal function which returns error message reported for a file."""
+    return f'{type(error).__name__}: {error}'
+
+def _parse_file(path):
+    """This is internal function which parses file and flattens it into rows with node ids
+    counted from 0. It returns (path, rows, error message)."""
+    try:
+        root = ElementTree.parse(path).getroot()
+        return path, xml_orm._flatten(root, 0, None, 1, 0, 1), None
+    except Exception as error:
+        return path, None, _error(error)
+
+def _result(path, future):
+    """This is internal function which returns result of _parse_file computed by the pool,
+    errors other than broken pool (e.g. result which can not be pickled) are errors of the
+    file."""
+    try:
+        return future.result()
+    except concurrent.futures.BrokenExecutor:
+        raise
+    except Exception as error:
+        return path, None, _error(error)
+
+def _parse_files(workers, files, window):
+    """This is internal generator which yields results of _parse_file computed by pool of
+    worker processes in order of files. At most window files are parsed or wait for the
+    writer, so memory does not grow when the writer is slower than the workers. When a worker
+    dies (e.g. killed on huge file), the pool is created again and files which were in
+    progress are parsed one by one, so only the file which kills the worker is reported."""
+    def new_pool():
+        return concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dict(xml_orm._settings),))
+    files, pending, suspects = iter(files), collections.deque(), collections.deque()
+    pool = new_pool()
+    try:
+        while True:
+            if suspects:
+                path = suspects.popleft()
+                try:
+                    result = _result(path, pool.submit(_parse_file, path))
+                except concurrent.futures.BrokenExecutor as error:
+                    pool.shutdown()
+                    pool = new_pool()
+                    result = path, None, _error(error)
+                yield result
+                continue
+            try:
+                while len(pending) < window and (path := next(files, None)) is not None:
+                    pending.append([path, None])
+                    pending[-1][1] = pool.submit(_parse_file, path)
+                if not pending:
+                    return
+                result = _result(*pending[0])
+                pending.popleft()
+            except concurrent.futures.BrokenExecutor:
+                pool.shutdown()
+                pool = new_pool()
+                suspects.extend(path for path, _ in pending)
+                pending.clear()
+                continue
+            yield result
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+def _save_file(path, rows):
+    """This is internal function which saves rows of one file in its own transaction, it
+    returns (root id, written rows)."""
+    with Session(xml_orm.get_engine(write=True)) as session:
+        root_id, written = _save_rows(session, rows)
+        xml_orm._commit(session)
+    xml_orm._invalidate(root_id)
+    return root_id, written
+
+def _save_rows(session, rows):
+    """This is internal function which saves document flattened by _parse_file, node ids are
+    moved behind the id of the saved root node. It returns (root id, written rows)."""
+    root, root_attributes = rows[0]
+    top = xml_orm._save_root(session, root['name'])
+    top.last_line = root['last_line']
+    base = top.node_id
+    for node, _ in rows[1:]:
+        node['node_id'] += base
+        node['parent_node'] += base
+        node['doc_id'] = base
+    for _, attributes in rows:
+        for attrib in attributes:
+            attrib['node_id'] += base
+            attrib['doc_id'] = base
+    return base, xml_orm._bulk_insert(session, rows[1:]) + xml_orm._flush_rows(session, [], root_attributes) + 1
+
+@xml_orm._instrumented
+def import_directory(path, workers=None, pattern='*.xml', progress=None):
+    """This function saves all files matching pattern in the directory and its subdirectories
+    as new xml documents, files are imported in order of their paths.
+    - workers is number of processes which parse files, default is number of CPUs, 1 parses
+      files in this process
+    - progress is called after every file with (done, total, path, root id, error message),
+      root id is None when the file was not saved
+    It returns dictionary with imported (path: root id), errors (path: message), rows
+    (number of written rows) and seconds."""
+    files = sorted(str(file) for file in pathlib.Path(path).rglob(pattern) if file.is_file())
+    workers = workers or os.cpu_count() or 1
+    result = {'imported': {}, 'errors': {}, 'rows': 0, 'seconds': 0.0}
+    started = time.perf_counter()
+    if workers > 1 and len(files) > 1:
+        parsed = _parse_files(min(workers, len(files)), files, 2 * workers)
+    else:
+        parsed = (_parse_file(path) for path in files)
+    with contextlib.closing(parsed):
+        for done, (file, rows, error) in enumerate(parsed, 1):
+            root_id = None
+            if error is None:
+                try:
+                    root_id, written = _save_file(file, rows)
+                    result['imported'][file] = root_id
+                    result['rows'] += written
+                except Exception as save_error: # e.g. locked database, the next file is tried
+                    root_id, error = None, _error(save_error)
+            if error is not None:
+                logger.warning("%s was not imported: %s", file, error)
+                result['errors'][file] = error
+            if progress:
+                progress(done, len(files), file, root_id, error)
+    result['seconds'] = time.perf_counter() - started
+    logger.info("imported %d of %d files, %d rows in %.3f s", len(result['imported']), len(files), result['rows'], result['seconds'])
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory', help='directory with xml files')
+    parser.add_argument('--workers', type=int, default=None, help='number of parsing processes, default is number of CPUs')
+    parser.add_argument('--pattern', default='*.xml', help='glob pattern of imported files')
+    parser.add_argument('--url', default=None, help='SQLAlchemy url of SQLite database, default is sqlite:///XML-database.db')
+    arguments = parser.parse_args()
+    if arguments.url:
+        xml_orm.configure(url=arguments.url)
+
+    def report(done, total, path, root_id, error):
+        if error:
+            print(f'[{done}/{total}] {path}: {error}', file=sys.stderr)
+        else:
+            print(f'[{done}/{total}] {path}: saved with id {root_id}')
+
+    result = import_directory(arguments.directory, arguments.workers, arguments.pattern, report)
+    seconds = result['seconds']
+    print(f"Imported {len(result['imported'])} files, {len(result['errors'])} failed, {result['rows']} rows in {seconds:.2f} s"
+          f" ({result['rows'] / seconds if seconds else 0:.0f} rows/s)")
+    sys.exit(1 if result['errors'] else 0)
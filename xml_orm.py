@@ -1,203 +1,1598 @@
-from sqlalchemy import Column, Integer, String, create_engine, ForeignKey
+from sqlalchemy import Column, Integer, String, create_engine, ForeignKey, Index, and_, bindparam, delete, event, exc, exists, func, insert, inspect, literal, or_, select, text, update
 from sqlalchemy.orm import declarative_base, Session
 from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from collections import OrderedDict
+import contextlib, contextvars, functools, json, logging, re, sqlite3, threading, time, zlib
+
+logger = logging.getLogger(__name__)
+stats_logger = logging.getLogger(__name__ + '.stats')
+
+BULK_BATCH_SIZE = 5000
+STREAM_BATCH_SIZE = 1000
+ORDER_GAP = 1024
+FULL_TEXT_TABLE = 'XmlAttributesFts'
+last_bulk_stats = None
 
-engine = create_engine('sqlite:///XML-database.db')
 Base = declarative_base()
 
+class XmlNames(Base):
+    """This is database model which contains tag names and attribute keys, nodes and
+    attributes refer to them by id, so every name is stored only once."""
+    __tablename__ = 'XmlNames'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+
 class XmlNodes(Base):
     """This is database model which contains xml nodes with their structure.
     For example we have <parent><child></child></parent>, then parent and child are
-    saved as name in record, parent_node of parent is null and parent of child is the
-    primary key of parent record."""
+    saved as name_id (id of the tag in XmlNames) in record, parent_node of parent is null
+    and parent of child is the primary key of parent record. doc_id is the id of root node of the document which
+    contains the node. line is the position of the node in document order (the line
+    returned by load_xml, root is line 1) and last_line is the line of its last descendant,
+    so descendants of the node are the nodes with line in (line, last_line]."""
     __tablename__ = 'XmlNodes'
     node_id = Column('node_id', Integer, primary_key=True)
-    name = Column(String, nullable=False)
+    name_id = Column(Integer, ForeignKey('XmlNames.id'), nullable=False)
     parent_node = Column(Integer, ForeignKey('XmlNodes.node_id'))
     order = Column(Integer, nullable=False)
+    doc_id = Column(Integer)
+    line = Column(Integer)
+    last_line = Column(Integer)
+    __table_args__ = (
+        Index('ix_XmlNodes_parent_node_order', 'parent_node', 'order'),
+        Index('ix_XmlNodes_doc_id_line', 'doc_id', 'line'),
+        Index('ix_XmlNodes_doc_id_name_id', 'doc_id', 'name_id'),
+    )
 
-    def __init__(self, name, parent_node, order):
-        self.name = name
+    def __init__(self, name_id, parent_node, order, doc_id=None, line=None, last_line=None):
+        self.name_id = name_id
         self.parent_node = parent_node
         self.order = order
+        self.doc_id = doc_id
+        self.line = line
+        self.last_line = last_line
 
 class XmlAttribute(Base):
     """This is database model which contains attributes and text values of
-    specified node"""
+    specified node, key_id is id of the key in XmlNames (__text__ for text). Long text
+    values are stored compressed when compress_text is configured."""
     __tablename__ = 'XmlAttributes'
     id = Column(Integer, primary_key=True)
     node_id = Column(Integer, ForeignKey('XmlNodes.node_id'))
-    key = Column(String, nullable=False)
+    key_id = Column(Integer, ForeignKey('XmlNames.id'), nullable=False)
     value = Column(String, nullable=False)
+    doc_id = Column(Integer)
+    __table_args__ = (
+        Index('ix_XmlAttributes_node_id_key_id', 'node_id', 'key_id'),
+        Index('ix_XmlAttributes_doc_id_value', 'doc_id', 'value'),
+    )
 
-    def __init__(self, node_id, key, value):
+    def __init__(self, node_id, key_id, value, doc_id=None):
         self.node_id = node_id
-        self.key = key
+        self.key_id = key_id
         self.value = value
+        self.doc_id = doc_id
+
+_ADDED_COLUMNS = {'XmlNodes': ['doc_id', 'line', 'last_line', 'name_id'], 'XmlAttributes': ['doc_id', 'key_id']}
+_DROPPED_INDEXES = ['ix_XmlNodes_doc_id', 'ix_XmlNodes_doc_id_name', 'ix_XmlAttributes_node_id_key']
+_INTERNED_COLUMNS = {'XmlNodes': ('name', 'name_id'), 'XmlAttributes': ('key', 'key_id')}
+
+def _preorder_lines(nodes, top_id, first_line):
+    """This is internal function which numbers nodes in document order.
+    - nodes are (node_id, parent_node, order) rows of the subtree
+    It returns dictionary node_id: (line, last_line)."""
+    children = {}
+    for node in sorted(nodes, key=lambda node: node.order, reverse=True):
+        children.setdefault(node.parent_node, []).append(node.node_id)
+    preorder, stack = [], [top_id]
+    while stack:
+        node_id = stack.pop()
+        preorder.append(node_id)
+        stack.extend(children.get(node_id, []))
+    position = {node_id: first_line + i for i, node_id in enumerate(preorder)}
+    last = dict(position)
+    for node_id in reversed(preorder):
+        for child_id in children.get(node_id, []):
+            last[node_id] = max(last[node_id], last[child_id])
+    return {node_id: (position[node_id], last[node_id]) for node_id in preorder}
+
+def migrate_schema(bind):
+    """This function upgrades database created by older version of this module in place.
+    It adds doc_id, line and last_line columns, fills doc_id by walking the trees level by
+    level, numbers lines of every document, moves tag names and attribute keys into XmlNames
+    (needs SQLite 3.35 to drop the old columns) and creates missing indexes. It does nothing
+    on up to date database."""
+    with bind.begin() as connection:
+        _migrate(connection)
+
+def _migrate(connection):
+    """This is internal function which upgrades schema using connection in transaction."""
+    XmlNames.__table__.create(connection, checkfirst=True)
+    for table in Base.metadata.sorted_tables:
+        columns = [column['name'] for column in inspect(connection).get_columns(table.name)]
+        for column in _ADDED_COLUMNS.get(table.name, []):
+            if column not in columns:
+                connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN {column} INTEGER'))
+    for index in _DROPPED_INDEXES:
+        connection.execute(text(f'DROP INDEX IF EXISTS "{index}"'))
+    _intern_columns(connection)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+    nodes = XmlNodes.__table__
+    connection.execute(update(nodes).where(nodes.c.parent_node == None, nodes.c.doc_id == None).values(doc_id=nodes.c.node_id))
+    parent = nodes.alias('parent')
+    parent_doc = select(parent.c.doc_id).where(parent.c.node_id == nodes.c.parent_node).scalar_subquery()
+    while connection.execute(update(nodes).where(nodes.c.doc_id == None, parent_doc != None).values(doc_id=parent_doc)).rowcount:
+        pass
+    attributes = XmlAttribute.__table__
+    node_doc = select(nodes.c.doc_id).where(nodes.c.node_id == attributes.c.node_id).scalar_subquery()
+    connection.execute(update(attributes).where(attributes.c.doc_id == None).values(doc_id=node_doc))
+
+    set_lines = update(nodes).where(nodes.c.node_id == bindparam('b_node_id')).values(line=bindparam('b_line'), last_line=bindparam('b_last_line'))
+    for doc_id, in connection.execute(select(nodes.c.doc_id).where(nodes.c.line == None).distinct()).all():
+        doc_nodes = connection.execute(select(nodes.c.node_id, nodes.c.parent_node, nodes.c.order).where(nodes.c.doc_id == doc_id)).all()
+        lines = _preorder_lines(doc_nodes, doc_id, 1)
+        connection.execute(set_lines, [{'b_node_id': node_id, 'b_line': line, 'b_last_line': last_line} for node_id, (line, last_line) in lines.items()])
+
+def _intern_columns(connection):
+    """This is internal function which moves names and keys stored as strings by older version
+    into XmlNames and drops the string columns. Full text index is created again, because
+    its triggers changed."""
+    for table, (column, id_column) in _INTERNED_COLUMNS.items():
+        if column not in [column['name'] for column in inspect(connection).get_columns(table)]:
+            continue
+        connection.execute(text(f'INSERT INTO "XmlNames" (name) SELECT DISTINCT "{column}" FROM "{table}" WHERE "{column}" NOT IN (SELECT name FROM "XmlNames")'))
+        connection.execute(text(f'UPDATE "{table}" SET {id_column} = (SELECT id FROM "XmlNames" WHERE name = "{table}"."{column}")'))
+        full_text = _full_text_enabled(connection)
+        _disable_full_text_search(connection)
+        connection.execute(text(f'ALTER TABLE "{table}" DROP COLUMN "{column}"'))
+        if full_text:
+            _enable_full_text_search(connection)
+
+def _prepare_database(connection):
+    """This is internal function which creates missing tables and upgrades the schema."""
+    Base.metadata.create_all(connection)
+    _migrate(connection)
+
+def _schema_current(connection):
+    """This is internal function which checks in read transaction that all tables, columns and
+    indexes exist, old columns and indexes are gone and no rows wait for doc_id or line. Only
+    otherwise the database is prepared in write transaction, so starting process does not wait
+    for the write lock."""
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            return False
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        if not {column.name for column in table.columns} <= columns or _INTERNED_COLUMNS.get(table.name, ('',))[0] in columns:
+            return False
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        if not {index.name for index in table.indexes} <= indexes or indexes & set(_DROPPED_INDEXES):
+            return False
+    nodes, attributes = XmlNodes.__table__, XmlAttribute.__table__
+    return not connection.execute(select(or_(exists().where(nodes.c.doc_id == None), exists().where(nodes.c.line == None),
+                                             exists().where(attributes.c.doc_id == None)))).scalar()
+
+_settings = {
+    'url': 'sqlite:///XML-database.db',
+    'pool_size': 5,
+    'busy_timeout': 30,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -65536,
+    'mmap_size': 268435456,
+    'compress_text': None,
+}
+_engines = None
+_engines_lock = threading.Lock()
+
+def configure(**settings):
+    """This function sets database connection, it can be called before the first use of the
+    database or later, then the current engine is disposed. Engine is created lazily by
+    get_engine. Tables are created and migrated when the engine is created.
+    - url is SQLAlchemy url of SQLite database, default is sqlite:///XML-database.db. Other
+      databases are not supported, ids of saved nodes are assigned from max(rowid) under the
+      SQLite write lock
+    - pool_size is number of kept open connections
+    - busy_timeout is number of seconds to wait for locked SQLite database
+    - journal_mode, synchronous, cache_size and mmap_size are SQLite pragmas set on every
+      connection, None keeps the SQLite default
+    - compress_text is number of characters from which saved texts are compressed by zlib,
+      None turns compression off. Compressed texts are not found by value search
+    With SQLite every session runs in a transaction, so it reads consistent snapshot of the
+    database. Writing functions start with BEGIN IMMEDIATE, so writers wait for each other
+    (up to busy_timeout) instead of failing. Default WAL journal lets any number of reader
+    threads or processes work while one writer saves, readers see the last committed state."""
+    global _engines
+    unknown = set(settings) - set(_settings)
+    if unknown:
+        raise TypeError(f"Unknown settings {', '.join(sorted(unknown))}")
+    if not settings.get('url', 'sqlite:').startswith('sqlite'):
+        raise ValueError(f"Only SQLite database is supported, not {settings['url']}")
+    with _engines_lock:
+        _settings.update(settings)
+        if _engines:
+            _engines[0].dispose()
+        _engines = None
+    _invalidate()
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    """This is internal function which sets pragmas of new SQLite connection and turns off
+    transaction handling of the driver, transactions are started by _sqlite_begin."""
+    dbapi_connection.isolation_level = None
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {int(_settings['busy_timeout'] * 1000)}")
+    for pragma in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size'):
+        if _settings[pragma] is not None:
+            cursor.execute(f"PRAGMA {pragma} = {_settings[pragma]}")
+    cursor.close()
+
+def _sqlite_begin(connection):
+    """This is internal function which starts SQLite transaction, immediate for writers."""
+    connection.exec_driver_sql('BEGIN IMMEDIATE' if connection.get_execution_options().get('xml_orm_write') else 'BEGIN')
+
+def _create_engines():
+    """This is internal function which creates engine for the current settings and prepares
+    the database. It returns (reading engine, writing engine)."""
+    engine = create_engine(_settings['url'], pool_size=_settings['pool_size'], connect_args={'timeout': _settings['busy_timeout'], 'factory': _CountingConnection})
+    event.listen(engine, 'connect', _sqlite_connect)
+    event.listen(engine, 'begin', _sqlite_begin)
+    _instrument_engine(engine)
+    writer = engine.execution_options(xml_orm_write=True)
+    with engine.connect() as connection:
+        current = _schema_current(connection)
+    if not current:
+        with writer.begin() as connection:
+            _prepare_database(connection)
+    return engine, writer
+
+def get_engine(write=False):
+    """This function returns engine of the configured database, it is created on first use.
+    - write selects engine whose transactions take the write lock at start"""
+    global _engines
+    engines = _engines
+    if engines is None:
+        with _engines_lock:
+            if _engines is None:
+                _engines = _create_engines()
+            engines = _engines
+    return engines[1] if write else engines[0]
+
+def __getattr__(name):
+    """Module attribute engine is kept for compatibility, it is the engine of get_engine."""
+    if name == 'engine':
+        return get_engine()
+    raise AttributeError(f"module {__name__} has no attribute {name}")
+
+
+_COUNTERS = ('statements', 'rows_read', 'rows_written', 'commits')
+_collectors = contextvars.ContextVar('xml_orm_collectors', default=())
+_operation = contextvars.ContextVar('xml_orm_operation', default=None)
+_stats = None
+_stats_log = False
+_stats_lock = threading.Lock()
+
+def _count(counter, value=1):
+    """This is internal function which adds value to the counter of all active collectors."""
+    for collector in _collectors.get():
+        collector[counter] += value
 
-Base.metadata.create_all(engine)
+def _count_statement(connection, cursor, statement, parameters, context, executemany):
+    """This is internal function which counts executed statement."""
+    _count('statements')
 
+def _count_written(connection, cursor, statement, parameters, context, executemany):
+    """This is internal function which counts rows changed by executed statement."""
+    if cursor.rowcount > 0:
+        _count('rows_written', cursor.rowcount)
+
+def _count_commit(connection):
+    """This is internal function which counts committed transaction."""
+    _count('commits')
+
+def _instrument_engine(engine):
+    """This is internal function which registers counting events of the engine."""
+    event.listen(engine, 'before_cursor_execute', _count_statement)
+    event.listen(engine, 'after_cursor_execute', _count_written)
+    event.listen(engine, 'commit', _count_commit)
+
+class _CountingCursor(sqlite3.Cursor):
+    """SQLite cursor which counts rows fetched from database."""
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count('rows_read')
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _count('rows_read', len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count('rows_read', len(rows))
+        return rows
+
+class _CountingConnection(sqlite3.Connection):
+    """SQLite connection which creates cursors counting fetched rows."""
+    def cursor(self, factory=_CountingCursor):
+        return super().cursor(factory)
+
+def _start_operation(name):
+    """This is internal function which starts collecting statistics of public operation, it
+    returns state for _finish_operation or None when statistics are off or operation is nested."""
+    if _stats is None or _operation.get() is not None:
+        return None
+    collector = dict.fromkeys(_COUNTERS, 0)
+    return name, collector, _collectors.set(_collectors.get() + (collector,)), _operation.set(name), time.perf_counter()
+
+def _finish_operation(state):
+    """This is internal function which adds statistics of finished operation to the totals."""
+    if state is None:
+        return
+    name, collector, collectors_token, operation_token, started = state
+    _operation.reset(operation_token)
+    _collectors.reset(collectors_token)
+    collector['seconds'] = time.perf_counter() - started
+    with _stats_lock:
+        if _stats is not None:
+            totals = _stats.setdefault(name, dict(calls=0, seconds=0.0, **dict.fromkeys(_COUNTERS, 0)))
+            totals['calls'] += 1
+            for key, value in collector.items():
+                totals[key] += value
+    if _stats_log:
+        stats_logger.info(json.dumps({'operation': name, **collector}))
+
+def _instrumented(function):
+    """This is internal decorator which collects statistics of public function."""
+    name = f'{function.__module__}.{function.__name__}'
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        state = _start_operation(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _finish_operation(state)
+    return wrapper
+
+def enable_stats(log=False):
+    """This function turns on collecting statistics of public functions: number of calls, SQL
+    statements, rows read and written, commits and wall time in seconds.
+    - log writes statistics of every call as json to logger xml_orm.stats (level INFO)"""
+    global _stats, _stats_log
+    with _stats_lock:
+        if _stats is None:
+            _stats = {}
+        _stats_log = log
+
+def disable_stats():
+    """This function turns off collecting statistics and forgets collected ones."""
+    global _stats, _stats_log
+    with _stats_lock:
+        _stats, _stats_log = None, False
+
+def operation_stats(reset=False):
+    """This function returns dictionary function name: statistics collected since enable_stats.
+    Rows read are counted for the synchronous SQLite engine only.
+    - reset starts collecting from zero"""
+    global _stats
+    with _stats_lock:
+        if _stats is None:
+            return {}
+        stats = {name: dict(totals) for name, totals in _stats.items()}
+        if reset:
+            _stats = {}
+    return stats
+
+@contextlib.contextmanager
+def query_budget(statements=None):
+    """This function returns context manager which raises AssertionError when code in the block
+    executes more than given number of SQL statements (BEGIN included, COMMIT is not a
+    statement, it is counted in commits). It gives dictionary with counters of the block,
+    statistics do not have to be enabled.
+        with xml_orm.query_budget(5):
+            xml_orm.load_xml(root_id)"""
+    collector = dict.fromkeys(_COUNTERS, 0)
+    token = _collectors.set(_collectors.get() + (collector,))
+    try:
+        yield collector
+    finally:
+        _collectors.reset(token)
+    if statements is not None and collector['statements'] > statements:
+        raise AssertionError(f"{collector['statements']} SQL statements executed, budget is {statements}")
+
+def _drop_data(connection):
+    """This is internal function which recreates tables using connection in transaction.
+    XmlNames is kept, so ids of names cached by other processes stay valid."""
+    full_text = _full_text_enabled(connection)
+    _disable_full_text_search(connection)
+    tables = [XmlAttribute.__table__, XmlNodes.__table__]
+    Base.metadata.drop_all(connection, tables=tables)
+    Base.metadata.create_all(connection, tables=tables)
+    if full_text:
+        _enable_full_text_search(connection)
+
+@_instrumented
 def drop_data():
-    """This function allows to clear all tables in database."""
-    Base.metadata.drop_all(engine)
-    Base.metadata.create_all(engine)
+    """This function allows to clear all tables in database. Full text index is kept enabled,
+    dictionary of names (XmlNames) is kept, because other processes may have it cached."""
+    with get_engine(write=True).begin() as connection:
+        _drop_data(connection)
+    _invalidate()
+
+
+_names = {} # database: (dictionary name: id, dictionary id: name)
+
+def _forget_names():
+    """This is internal function which clears the cached dictionaries of names."""
+    _names.clear()
+
+def _cached_names(session):
+    """This is internal function which returns (dictionary name: id, dictionary id: name) of
+    names cached for the database of the session. Every database has its own dictionaries,
+    so sync and async engines of one database share them."""
+    url = session.get_bind().url
+    key = (url.get_backend_name(), url.host, url.port, url.database)
+    names = _names.get(key)
+    if names is None:
+        names = _names.setdefault(key, ({}, {}))
+    return names
+
+def _remember_names(session, names):
+    """This is internal function which adds committed name: id pairs to the cache."""
+    name_ids, names_by_id = _cached_names(session)
+    name_ids.update(names)
+    names_by_id.update((name_id, name) for name, name_id in names.items())
+
+def _intern(session, names):
+    """This is internal function which returns dictionary name: id for the given names, missing
+    names are added into XmlNames. Names added by the session are cached after commit."""
+    pending = session.info.setdefault('xml_orm_names', {})
+    name_ids = _cached_names(session)[0]
+    missing = [name for name in names if name not in name_ids and name not in pending]
+    if missing:
+        known = select(XmlNames.name, XmlNames.id)
+        found = dict(session.execute(known.where(XmlNames.name.in_(missing))).all())
+        new = [name for name in missing if name not in found]
+        if new:
+            session.execute(insert(XmlNames), [{'name': name} for name in new])
+            pending.update(session.execute(known.where(XmlNames.name.in_(new))).all())
+        _remember_names(session, found)
+    return {name: pending[name] if name in pending else name_ids[name] for name in names}
 
+def _name_id(session, name):
+    """This is internal function which returns id of one name, see _intern."""
+    return _intern(session, (name,))[name]
 
-def _save_node(session, node, parent_id):
-    """This is internal function which saves nodes recursively in database."""
+@event.listens_for(Session, 'after_commit')
+def _commit_names(session):
+    """This is internal function which caches names added by committed session."""
+    pending = session.info.pop('xml_orm_names', None)
+    if pending:
+        _remember_names(session, pending)
+
+@event.listens_for(Session, 'after_rollback')
+def _rollback_names(session):
+    """This is internal function which forgets names added by rolled back session."""
+    session.info.pop('xml_orm_names', None)
+
+class _NameLookup(dict):
+    """Dictionary id: name of XmlNames, unknown ids (added by other process) are loaded from
+    database."""
+    def __init__(self, session):
+        super().__init__(_cached_names(session)[1])
+        self.session = session
+
+    def __missing__(self, name_id):
+        names = dict(self.session.execute(select(XmlNames.name, XmlNames.id)).all())
+        _remember_names(self.session, names)
+        self.update((name_id, name) for name, name_id in names.items())
+        return dict.__getitem__(self, name_id)
+
+def _stored_value(key, value):
+    """This is internal function which returns value saved into XmlAttributes, long text is
+    compressed when compress_text is set."""
+    threshold = _settings['compress_text']
+    if key == '__text__' and threshold is not None and len(value) >= threshold:
+        return zlib.compress(value.encode('utf8'))
+    return value
+
+def _loaded_value(value):
+    """This is internal function which returns text of value read from XmlAttributes."""
+    return zlib.decompress(value).decode('utf8') if isinstance(value, bytes) else value
+
+
+def _save_node(session, node, parent_id, doc_id, next_line):
+    """This is internal function which saves nodes recursively in database.
+    - next_line is one element list with line of the next saved node"""
     for i, child in enumerate(node, 1):
-        new_node = XmlNodes(name=child.tag, parent_node=parent_id, order=i)
+        ids = _intern(session, {child.tag, '__text__', *child.keys()})
+        new_node = XmlNodes(name_id=ids[child.tag], parent_node=parent_id, order=i * ORDER_GAP, doc_id=doc_id, line=next_line[0])
+        next_line[0] += 1
         session.add(new_node)
         session.flush()
         if child.text and child.text.strip() != '':
-            new_text = XmlAttribute(node_id=new_node.node_id, key='__text__', value=child.text)
+            new_text = XmlAttribute(node_id=new_node.node_id, key_id=ids['__text__'], value=_stored_value('__text__', child.text), doc_id=doc_id)
             session.add(new_text)
 
         for attribute in child.items():
-            new_attr = XmlAttribute(node_id=new_node.node_id, key=attribute[0], value=attribute[1])
+            new_attr = XmlAttribute(node_id=new_node.node_id, key_id=ids[attribute[0]], value=attribute[1], doc_id=doc_id)
             session.add(new_attr)
-        _save_node(session, child, new_node.node_id)
+        _save_node(session, child, new_node.node_id, doc_id, next_line)
+        new_node.last_line = next_line[0] - 1
+
+def _attribute_rows(node_id, doc_id, element):
+    """This is internal function which returns XmlAttributes rows (text and attributes) of element,
+    keys are interned when the rows are written."""
+    rows = []
+    if element.text and element.text.strip() != '':
+        rows.append({'node_id': node_id, 'key': '__text__', 'value': _stored_value('__text__', element.text), 'doc_id': doc_id})
+    for key, value in element.items():
+        rows.append({'node_id': node_id, 'key': key, 'value': value, 'doc_id': doc_id})
+    return rows
+
+def _flatten(element, node_id, parent_id, order, doc_id, line):
+    """This is internal function which converts element and its descendants into list of rows
+    in document order. Node ids and lines are assigned consecutively starting from node_id and
+    line, so ids match the ids given by the recursive _save_node."""
+    rows, first_id = [], node_id
+    stack = [(element, parent_id, order)]
+    while stack:
+        element, parent_id, order = stack.pop()
+        node_line = line + node_id - first_id
+        rows.append(({'node_id': node_id, 'name': element.tag, 'parent_node': parent_id, 'order': order, 'doc_id': doc_id,
+                      'line': node_line, 'last_line': node_line}, _attribute_rows(node_id, doc_id, element)))
+        stack.extend((child, node_id, i * ORDER_GAP) for i, child in reversed(list(enumerate(element, 1))))
+        node_id += 1
+    for node, _ in reversed(rows[1:]):
+        parent = rows[node['parent_node'] - first_id][0]
+        parent['last_line'] = max(parent['last_line'], node['last_line'])
+    return rows
+
+def _bulk_insert(session, rows):
+    """This is internal function which writes (node, attributes) rows with batched
+    executemany inserts. Node can be None when it was already saved. It returns number
+    of written rows."""
+    nodes, attributes, written = [], [], 0
+    for node, node_attributes in rows:
+        if node is not None:
+            nodes.append(node)
+        attributes.extend(node_attributes)
+        if len(nodes) + len(attributes) >= BULK_BATCH_SIZE:
+            written += _flush_rows(session, nodes, attributes)
+            nodes, attributes = [], []
+    return written + _flush_rows(session, nodes, attributes)
+
+def _flush_rows(session, nodes, attributes):
+    """This is internal function which executes one batch of inserts, names of nodes and keys
+    of attributes are replaced by their ids."""
+    ids = _intern(session, {node['name'] for node in nodes} | {attrib['key'] for attrib in attributes})
+    for node in nodes:
+        node['name_id'] = ids[node.pop('name')]
+    for attrib in attributes:
+        attrib['key_id'] = ids[attrib.pop('key')]
+    if nodes:
+        session.execute(insert(XmlNodes.__table__), nodes)
+    if attributes:
+        session.execute(insert(XmlAttribute.__table__), attributes)
+    return len(nodes) + len(attributes)
+
+def _save_root(session, name):
+    """This is internal function which saves root node of new document, doc_id of the root
+    is its own id."""
+    root_node = XmlNodes(name_id=_name_id(session, name), parent_node=None, order=1, line=1, last_line=1)
+    session.add(root_node)
+    session.flush()
+    root_node.doc_id = root_node.node_id
+    session.flush()
+    return root_node
+
+def _bulk_save(session, element, parent_id, order, doc_id=None, line=1):
+    """This is internal function which saves element with its descendants using bulk inserts.
+    Top node is inserted first to get its id and to take the database write lock, so the
+    following ids are reserved for this transaction. New document is created when doc_id
+    is None. It returns (top node id, written rows)."""
+    if doc_id is None:
+        top = _save_root(session, element.tag)
+        doc_id = top.node_id
+    else:
+        top = XmlNodes(name_id=_name_id(session, element.tag), parent_node=parent_id, order=order, doc_id=doc_id, line=line)
+        session.add(top)
+        session.flush()
+    rows = _flatten(element, top.node_id, parent_id, order, doc_id, line)
+    top.last_line = rows[0][0]['last_line']
+    written = _bulk_insert(session, rows[1:]) + _flush_rows(session, [], rows[0][1]) + 1
+    return top.node_id, written
+
+def _shift_lines(session, doc_id, line, last_line, count):
+    """This is internal function which makes room for count nodes behind line last_line inside
+    the node in the given line (its last descendant or its child placed before the new ones),
+    negative count closes the gap left by the deleted subtree which spanned lines
+    line..last_line. Ancestors of the node are extended and following nodes are moved, nodes
+    in lines line+1..last_line stay in place."""
+    session.execute(update(XmlNodes).where(XmlNodes.doc_id == doc_id, XmlNodes.last_line >= last_line, ~XmlNodes.line.between(line + 1, last_line))
+                    .values(last_line=XmlNodes.last_line + count))
+    session.execute(update(XmlNodes).where(XmlNodes.doc_id == doc_id, XmlNodes.line > last_line).values(line=XmlNodes.line + count))
+
+def _shift_blocks(session, doc_id, blocks, span):
+    """This is internal function which moves lines of sibling subtrees after their order
+    changed. Only nodes between the moved siblings are updated, with one range UPDATE per block.
+    - blocks are (line, last_line, offset) of moved subtrees, they are shifted to negative
+      lines first, so they do not clash with the span
+    - span is (line, last_line, offset) of nodes between them, shifted in place"""
+    blocks = [block for block in blocks if block[2]]
+    for line, last_line, offset in blocks:
+        session.execute(update(XmlNodes).where(XmlNodes.doc_id == doc_id, XmlNodes.line.between(line, last_line))
+                        .values(line=-(XmlNodes.line + offset), last_line=-(XmlNodes.last_line + offset)).execution_options(synchronize_session=False))
+    line, last_line, offset = span
+    if offset and line <= last_line:
+        session.execute(update(XmlNodes).where(XmlNodes.doc_id == doc_id, XmlNodes.line.between(line, last_line))
+                        .values(line=XmlNodes.line + offset, last_line=XmlNodes.last_line + offset).execution_options(synchronize_session=False))
+    if blocks:
+        session.execute(update(XmlNodes).where(XmlNodes.doc_id == doc_id, XmlNodes.line < 0)
+                        .values(line=-XmlNodes.line, last_line=-XmlNodes.last_line).execution_options(synchronize_session=False))
+
+def _respace_children(session, parent_id):
+    """This is internal function which sets order of children of parent to multiples of
+    ORDER_GAP, it is needed only when there is no free order between two siblings."""
+    children = session.scalars(select(XmlNodes.node_id).where(XmlNodes.parent_node == parent_id).order_by(XmlNodes.order)).all()
+    session.execute(update(XmlNodes), [{'node_id': node_id, 'order': i * ORDER_GAP} for i, node_id in enumerate(children, 1)])
+
+def _sibling_slot(session, parent, position=None, exclude=None):
+    """This is internal function which returns (order, line) for node placed as child of parent
+    at position (counted from 1, None or position behind the last child appends the node).
+    Order lies between orders of the neighbours, line is the line where the node starts.
+    - exclude is id of child which is moved and does not count as sibling"""
+    if position is not None and int(position) < 1:
+        raise ValueError(f"Position {position} is not positive")
+    siblings = select(XmlNodes.order, XmlNodes.line).where(XmlNodes.parent_node == parent.node_id)
+    if exclude is not None:
+        siblings = siblings.where(XmlNodes.node_id != exclude)
+    if position is None:
+        previous, following = session.execute(siblings.order_by(XmlNodes.order.desc()).limit(1)).first(), None
+    elif int(position) == 1:
+        previous, following = None, session.execute(siblings.order_by(XmlNodes.order).limit(1)).first()
+    else:
+        neighbours = session.execute(siblings.order_by(XmlNodes.order).offset(int(position) - 2).limit(2)).all()
+        if not neighbours:
+            return _sibling_slot(session, parent, None, exclude)
+        previous, following = neighbours[0], neighbours[1] if len(neighbours) > 1 else None
+    if following is None:
+        return (previous.order + ORDER_GAP if previous else ORDER_GAP), parent.last_line + 1
+    if previous is None:
+        return following.order - ORDER_GAP, following.line
+    if following.order - previous.order > 1:
+        return (previous.order + following.order) // 2, following.line
+    _respace_children(session, parent.node_id)
+    return _sibling_slot(session, parent, position, exclude)
+
+def _report_bulk(written, started):
+    """This is internal function which stores and logs bulk insert throughput."""
+    global last_bulk_stats
+    seconds = time.perf_counter() - started
+    last_bulk_stats = {'rows': written, 'seconds': seconds, 'rows_per_second': written / seconds if seconds else float('inf')}
+    logger.info("bulk insert: %d rows in %.3f s (%.0f rows/s)", written, seconds, last_bulk_stats['rows_per_second'])
+
+def _commit(session):
+    """This is internal function which commits session and rolls it back on failure."""
+    try:
+        session.commit()
+    except exc.SQLAlchemyError:
+        session.rollback() # there were changes in database
+        raise
 
-def save_xml(xml):
+def _save_xml(session, root, bulk=True):
+    """This is internal function which saves parsed document, it returns (root id, written
+    rows or None for ORM path)."""
+    if bulk:
+        return _bulk_save(session, root, None, 1)
+    root_node = _save_root(session, root.tag)
+    if root.text and root.text.strip() != '':
+        new_text = XmlAttribute(node_id=root_node.node_id, key_id=_name_id(session, '__text__'), value=_stored_value('__text__', root.text), doc_id=root_node.node_id)
+        session.add(new_text)
+    next_line = [2]
+    _save_node(session, root, root_node.node_id, root_node.node_id, next_line)
+    root_node.last_line = next_line[0] - 1
+    session.flush()
+    return root_node.node_id, None
+
+@_instrumented
+def save_xml(xml, bulk=True):
     """This function saves xml document into database. It throws ElementTree.ParseError when
-    xml parsing fail."""
+    xml parsing fail. It returns id of the root node.
+    - bulk selects batched inserts in one transaction, throughput is stored in last_bulk_stats.
+      bulk=False uses the ORM path which flushes every node."""
     root = ElementTree.fromstring(xml)
 
-    with Session(engine) as session:
-        root_node = XmlNodes(name=root.tag, parent_node=None, order=1)
-        session.add(root_node)
-        session.flush()
-        if root.text and root.text.strip() != '':
-            new_text = XmlAttribute(node_id=root_node.node_id, key='__text__', value=root.text)
-            session.add(new_text)
-        _save_node(session, root, root_node.node_id)
-        try:
-            session.commit()
-        except exc.SQLAlchemyError:
-            session.rollback() # there were changes in database
+    with Session(get_engine(write=True)) as session:
+        started = time.perf_counter()
+        root_id, written = _save_xml(session, root, bulk)
+        _commit(session)
+    _invalidate(root_id)
+    if bulk:
+        _report_bulk(written, started)
+    return root_id
+
 
+def _stream_rows(events, root, root_id):
+    """This is internal function which converts iterparse events into rows. Row of the node
+    is produced when its end tag is parsed, after that the element is cleared and detached
+    from its parent, so only the currently open elements are kept in memory. Root row is
+    already saved, so None is produced instead of it."""
+    stack = [[root, root_id, 0, None]]
+    next_id = root_id + 1
+    for event, element in events:
+        if event == 'start':
+            parent = stack[-1]
+            parent[2] += ORDER_GAP
+            node = {'node_id': next_id, 'name': element.tag, 'parent_node': parent[1], 'order': parent[2], 'doc_id': root_id,
+                    'line': next_id - root_id + 1}
+            stack.append([element, next_id, 0, node])
+            next_id += 1
+        else:
+            element, node_id, _, node = stack.pop()
+            if node is not None:
+                node['last_line'] = next_id - root_id
+            yield node, _attribute_rows(node_id, root_id, element)
+            element.clear()
+            if stack:
+                stack[-1][0].remove(element)
 
-def _load_attributes(session, node, node_id):
-    """This is internal function which loads node attribiutes."""
-    attributes = session.query(XmlAttribute).filter(XmlAttribute.node_id == node_id).all()
+def _save_xml_file(session, source):
+    """This is internal function which saves document parsed from source while it is read,
+    it returns (root id, written rows)."""
+    events = ElementTree.iterparse(source, events=('start', 'end'))
+    _, root = next(events)
+    root_node = _save_root(session, root.tag)
+    written = _bulk_insert(session, _stream_rows(events, root, root_node.node_id)) + 1
+    root_node.last_line = session.query(func.max(XmlNodes.line)).filter(XmlNodes.doc_id == root_node.node_id).scalar()
+    session.flush()
+    return root_node.node_id, written
+
+@_instrumented
+def save_xml_file(source):
+    """This function saves xml document from file into database without reading whole file
+    into memory. Nodes are written in batches while the file is parsed.
+    - source is path to the file or binary stream
+    It throws ElementTree.ParseError when xml parsing fail, nothing is saved then."""
+    with Session(get_engine(write=True)) as session:
+        started = time.perf_counter()
+        root_id, written = _save_xml_file(session, source)
+        _commit(session)
+    _invalidate(root_id)
+    _report_bulk(written, started)
+    return root_id
+
+
+def _subtree_cte(node_id):
+    """This is internal function which returns recursive CTE with ids of node_id and all
+    its descendants."""
+    tree = select(XmlNodes.node_id).where(XmlNodes.node_id == node_id).cte('subtree', recursive=True)
+    return tree.union_all(select(XmlNodes.node_id).where(XmlNodes.parent_node == tree.c.node_id))
+
+def _build_tree(nodes, attributes, top_id, names):
+    """This is internal function which assembles ElementTree from fetched rows in one pass.
+    - nodes are (node_id, name_id, parent_node, order) rows
+    - attributes are (node_id, key_id, value) rows
+    - names is dictionary id: name (_NameLookup)"""
+    children = {}
+    for node in sorted(nodes, key=lambda node: node.order):
+        children.setdefault(node.parent_node, []).append(node)
+    top = next(node for node in nodes if node.node_id == top_id)
+    elements = {top_id: ElementTree.Element(names[top.name_id])}
+    stack = [top_id]
+    while stack:
+        parent_id = stack.pop()
+        for child in children.get(parent_id, []):
+            elements[child.node_id] = ElementTree.SubElement(elements[parent_id], names[child.name_id])
+            stack.append(child.node_id)
     for attrib in attributes:
-        if attrib.key == '__text__':
-            node.text = attrib.value
+        key = names[attrib.key_id]
+        if key == '__text__':
+            elements[attrib.node_id].text = _loaded_value(attrib.value)
         else:
-            node.set(attrib.key, attrib.value)
+            elements[attrib.node_id].set(key, attrib.value)
+    return elements[top_id]
 
-def _load_node(session, parent, parent_node_id):
-    """This is internal function which loads nodes from database."""
-    nodes = session.query(XmlNodes).filter(XmlNodes.parent_node == parent_node_id).order_by(XmlNodes.order).all()
-    for node in nodes:
-        new_node = ElementTree.SubElement(parent, node.name)
-        _load_attributes(session, new_node, node.node_id)
-        _load_node(session, new_node, node.node_id)
+def _load_tree(session, node_id, root_only=False):
+    """This is internal function which loads node with its descendants using constant
+    number of queries. Whole document (root_only) is read by doc_id index range, other
+    subtrees by recursive CTE. It returns the element and dictionary line: node_id."""
+    nodes = select(XmlNodes.node_id, XmlNodes.name_id, XmlNodes.parent_node, XmlNodes.order, XmlNodes.line)
+    attributes = select(XmlAttribute.node_id, XmlAttribute.key_id, XmlAttribute.value).order_by(XmlAttribute.id)
+    if root_only:
+        nodes = nodes.where(XmlNodes.doc_id == node_id)
+        attributes = attributes.where(XmlAttribute.doc_id == node_id)
+    else:
+        tree = _subtree_cte(node_id)
+        nodes = nodes.join(tree, XmlNodes.node_id == tree.c.node_id)
+        attributes = attributes.join(tree, XmlAttribute.node_id == tree.c.node_id)
+    nodes = session.execute(nodes).all()
+    if not nodes:
+        raise ValueError(f"There is no xml with id {node_id}")
+    return _build_tree(nodes, session.execute(attributes).all(), node_id, _NameLookup(session)), {node.line: node.node_id for node in nodes}
+
+def _tostring(element, declaration=True):
+    """This is internal function which serializes element in the format returned by load_xml."""
+    if declaration:
+        return ElementTree.tostring(element, encoding='utf8', method='xml').decode().replace("><", ">\n<")
+    return ElementTree.tostring(element, encoding='unicode', method='xml').replace("><", ">\n<")
+
+class DocumentCache:
+    """This is LRU cache of loaded documents keyed by root node id. Every entry contains
+    serialized document and dictionary line: node_id. Functions which modify documents
+    invalidate their entries. Entry read before an invalidation is not stored, so readers
+    racing with writers can not put stale document into the cache."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.epoch = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def get(self, root_id):
+        with self.lock:
+            entry = self.entries.get(root_id)
+            if entry is None:
+                self.misses += 1
+                return None, self.epoch
+            self.hits += 1
+            self.entries.move_to_end(root_id)
+            return entry, self.epoch
+
+    def put(self, root_id, entry, epoch):
+        with self.lock:
+            if epoch != self.epoch:
+                return
+            self.entries[root_id] = entry
+            self.entries.move_to_end(root_id)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, root_id=None):
+        """Removes entry of root_id, or all entries when root_id is None."""
+        with self.lock:
+            self.epoch += 1
+            self.invalidations += 1
+            if root_id is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(root_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.entries), 'max_size': self.size, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
+
+_cache = None
+
+def enable_cache(size=32):
+    """This function turns on cache of size recently loaded documents used by load_xml and
+    get_id_by_line_number."""
+    global _cache
+    _cache = DocumentCache(size)
+
+def disable_cache():
+    """This function turns off and clears cache of loaded documents."""
+    global _cache
+    _cache = None
+
+def cache_stats():
+    """This function returns dictionary with size, hits, misses, evictions and invalidations
+    of the document cache, or None when the cache is disabled."""
+    return _cache.stats() if _cache else None
+
+def _invalidate(root_id=None):
+    """This is internal function which removes document (all documents when root_id is None)
+    from the cache."""
+    if _cache:
+        _cache.invalidate(root_id)
 
+def _load_document(session, id):
+    """This is internal function which returns (xml, dictionary line: node_id) of document."""
+    root_node, lines = _load_tree(session, id, root_only=True)
+    return _tostring(root_node), lines
+
+def _cached_document(id):
+    """This is internal function which returns (xml, dictionary line: node_id) of document
+    from the cache or from database."""
+    entry, epoch = _cache.get(id)
+    if entry is None:
+        with Session(get_engine()) as session:
+            entry = _load_document(session, id)
+        _cache.put(id, entry, epoch)
+    return entry
+
+@_instrumented
 def load_xml(id):
     """This function returns xml document.
     - id is the id of root node of the given xml. It can be read using available_xml function"""
-    with Session(engine) as session:
-        root = session.query(XmlNodes).filter(XmlNodes.parent_node == None, XmlNodes.node_id == id).first()
-        root_node = ElementTree.Element(root.name)
-        _load_attributes(session, root_node, root.node_id)
-        _load_node(session, root_node, root.node_id)
-    return ElementTree.tostring(root_node, encoding='utf8', method='xml').decode().replace("><", ">\n<")
+    if _cache:
+        return _cached_document(id)[0]
+    with Session(get_engine()) as session:
+        return _load_document(session, id)[0]
+
+def _available_xml(session):
+    """This is internal function which returns (id, name) of root nodes."""
+    return session.query(XmlNodes.node_id, XmlNames.name).join(XmlNames, XmlNames.id == XmlNodes.name_id).filter(XmlNodes.parent_node == None).order_by(XmlNodes.node_id).all()
 
+@_instrumented
 def available_xml():
     """This function returns name and id of all xml documents in database"""
-    with Session(engine) as session:
-        return session.query(XmlNodes.node_id, XmlNodes.name).filter(XmlNodes.parent_node == None).all()
-
-def _delete_node(session, node):
-    """This is internal function which deletes nodes recursively from database."""
-    for del_node in session.query(XmlNodes).filter(XmlNodes.parent_node == node).all():
-        _delete_node(session, del_node.node_id)
-        session.query(XmlAttribute).filter(XmlAttribute.node_id == del_node.node_id).delete()
-        session.commit()
-        session.query(XmlNodes).filter(XmlNodes.node_id == del_node.node_id).delete()
-        session.commit()
+    with Session(get_engine()) as session:
+        return _available_xml(session)
+
+def _delete_subtree(session, node):
+    """This is internal function which deletes node with all its descendants using set based
+    statements. Descendants are found by the line range of the node, whole document is
+    deleted by doc_id. Lines of remaining nodes are updated, order of siblings may have gaps."""
+    if node.parent_node is None:
+        session.execute(delete(XmlAttribute).where(XmlAttribute.doc_id == node.doc_id))
+        session.execute(delete(XmlNodes).where(XmlNodes.doc_id == node.doc_id).execution_options(synchronize_session=False))
+        return
+    subtree = select(XmlNodes.node_id).where(XmlNodes.doc_id == node.doc_id, XmlNodes.line.between(node.line, node.last_line))
+    session.execute(delete(XmlAttribute).where(XmlAttribute.node_id.in_(subtree)))
+    session.execute(delete(XmlNodes).where(XmlNodes.doc_id == node.doc_id, XmlNodes.line.between(node.line, node.last_line))
+                    .execution_options(synchronize_session=False))
+    _shift_lines(session, node.doc_id, node.line, node.last_line, node.line - node.last_line - 1)
 
+def _delete_xml(session, id):
+    """This is internal function which deletes subtree of node id, it returns doc_id."""
+    node = session.get(XmlNodes, id)
+    doc_id = node.doc_id
+    _delete_subtree(session, node)
+    return doc_id
+
+@_instrumented
 def delete_xml(id):
-    """This function deletes xml document from database by the given root node id."""
-    with Session(engine) as session:
-        root = session.query(XmlNodes).filter(XmlNodes.node_id == id)
-        _delete_node(session, root.first().node_id)
-        root.delete()
-        session.commit()
+    """This function deletes xml document from database by the given root node id.
+    Everything is deleted in one transaction."""
+    with Session(get_engine(write=True)) as session:
+        doc_id = _delete_xml(session, id)
+        _commit(session)
+    _invalidate(doc_id)
+
+def _node_at_line(session, root_id, line_num):
+    """This is internal function which returns node in the given line of the document."""
+    return session.query(XmlNodes).filter(XmlNodes.doc_id == root_id, XmlNodes.line == int(line_num)).one()
 
-def _iterate_to_get_id_by_line_number(session, id, search_line, curr_line):
-    """This is internal function which counts line number."""
-    curr_line[0] += 1
-    if curr_line[0] == search_line:
-        return id
-    for child in session.query(XmlNodes).filter(XmlNodes.parent_node == id).order_by(XmlNodes.order).all():
-        if found_id := _iterate_to_get_id_by_line_number(session, child.node_id, search_line, curr_line):
-            return found_id
+def _delete_line(session, root_id, line_num):
+    """This is internal function which deletes subtree in the given line."""
+    _delete_subtree(session, _node_at_line(session, root_id, line_num))
 
+@_instrumented
+def delete_subtree(root_id, line_num):
+    """This function deletes node in the given line with all its descendants from the given
+    xml(root_id). Deleting line 1 deletes whole document."""
+    with Session(get_engine(write=True)) as session:
+        _delete_line(session, root_id, line_num)
+        _commit(session)
+    _invalidate(root_id)
+
+def _line_to_id(session, root_id, line):
+    """This is internal function which returns node id in the given line, or None."""
+    return session.query(XmlNodes.node_id).filter(XmlNodes.doc_id == root_id, XmlNodes.line == int(line)).scalar()
+
+@_instrumented
 def get_id_by_line_number(line, root_id):
     """This function returns node id which is correlated with line
     <parent> this is line 1
         <node1></node1> line 2
         <node1></node1> line 3
     </parent> this is not line"""
-    with Session(engine) as session:
-        return _iterate_to_get_id_by_line_number(session, root_id, line, [0])    
+    entry = _cache.get(root_id)[0] if _cache else None
+    if entry is not None: # lines of cached document, a miss does not load whole document
+        return entry[1].get(int(line))
+    with Session(get_engine()) as session:
+        return _line_to_id(session, root_id, line)
+
+def _node_line(session, node_id):
+    """This is internal function which returns line of the node, or None."""
+    return session.scalar(select(XmlNodes.line).where(XmlNodes.node_id == node_id))
+
+@_instrumented
+def get_line_number(node_id):
+    """This function returns line of the node in its document (inverse of get_id_by_line_number),
+    or None when there is no such node. Line of node changes when nodes are added or moved
+    before it, node id does not change."""
+    with Session(get_engine()) as session:
+        return _node_line(session, node_id)
+
+def _node_entries(session, nodes):
+    """This is internal function which returns dictionaries describing nodes without their
+    children, nodes is select of XmlNodes.node_id which gives nodes in document order."""
+    page = nodes.subquery()
+    found = session.execute(select(XmlNodes.node_id, XmlNodes.name_id, XmlNodes.line, XmlNodes.last_line)
+                            .join(page, XmlNodes.node_id == page.c.node_id).order_by(XmlNodes.line)).all()
+    attributes, names = {}, _NameLookup(session)
+    for attrib in session.execute(select(XmlAttribute.node_id, XmlAttribute.key_id, XmlAttribute.value)
+                                  .where(XmlAttribute.node_id.in_(select(page.c.node_id))).order_by(XmlAttribute.id)).all():
+        attributes.setdefault(attrib.node_id, {})[names[attrib.key_id]] = attrib.value
+    entries = []
+    for node in found:
+        node_attributes = attributes.get(node.node_id, {})
+        text = node_attributes.pop('__text__', None)
+        entries.append({'node_id': node.node_id, 'line': node.line, 'last_line': node.last_line, 'name': names[node.name_id],
+                        'attributes': node_attributes, 'text': _loaded_value(text), 'has_children': node.last_line > node.line})
+    return entries
+
+def _load_node(session, node_id):
+    """This is internal function which returns entry of one node, or None."""
+    entries = _node_entries(session, select(XmlNodes.node_id).where(XmlNodes.node_id == node_id))
+    return entries[0] if entries else None
+
+@_instrumented
+def load_node(node_id):
+    """This function returns node without its children as dictionary with node_id, line,
+    last_line (line of its last descendant), name, attributes (dictionary key: value), text
+    (or None) and has_children, or None when there is no such node."""
+    with Session(get_engine()) as session:
+        return _load_node(session, node_id)
+
+def _load_children(session, node_id, offset=0, limit=None):
+    """This is internal function which returns entries of page of children of the node."""
+    children = select(XmlNodes.node_id).where(XmlNodes.parent_node == node_id).order_by(XmlNodes.order).offset(offset).limit(limit)
+    return _node_entries(session, children)
+
+@_instrumented
+def load_children(node_id, offset=0, limit=None):
+    """This function returns children of node in document order as list of dictionaries like
+    load_node, so big documents can be shown lazily level by level.
+    - offset and limit select page of children"""
+    with Session(get_engine()) as session:
+        return _load_children(session, node_id, offset, limit)
+
+def _resolve_node(session, root_id, line_or_node_id):
+    """This is internal function which returns node of the document given by its line or by
+    dictionary with node_id (like the ones returned by load_node)."""
+    if not isinstance(line_or_node_id, dict):
+        return _node_at_line(session, root_id, line_or_node_id)
+    node = session.get(XmlNodes, line_or_node_id['node_id'])
+    if node is None or node.doc_id != root_id:
+        raise ValueError(f"There is no node {line_or_node_id['node_id']} in xml with id {root_id}")
+    return node
+
+def _entries_tree(entries):
+    """This is internal function which assembles ElementTree from node entries in document
+    order, the first entry is the top element."""
+    stack = []
+    for entry in entries:
+        while stack and entry['line'] > stack[-1][1]:
+            stack.pop()
+        if stack:
+            element = ElementTree.SubElement(stack[-1][0], entry['name'], entry['attributes'])
+        else:
+            top = element = ElementTree.Element(entry['name'], entry['attributes'])
+        element.text = entry['text']
+        stack.append((element, entry['last_line']))
+    return top
+
+def _load_subtree(session, root_id, line_or_node_id, max_depth=None, offset=0, limit=None):
+    """This is internal function which returns page of subtree, see load_subtree. Children in
+    the window are consecutive siblings, so without max_depth their subtrees are one line
+    range, with max_depth they are read by recursive CTE counting the depth."""
+    if limit is not None and limit < 1 or offset < 0:
+        raise ValueError(f"Window of children with offset {offset} and limit {limit} is empty")
+    top = _resolve_node(session, root_id, line_or_node_id)
+    window = []
+    if max_depth is None or max_depth > 0:
+        children = select(XmlNodes.node_id, XmlNodes.line, XmlNodes.last_line).where(XmlNodes.parent_node == top.node_id).order_by(XmlNodes.order).offset(offset)
+        window = session.execute(children if limit is None else children.limit(limit + 1)).all()
+    more = limit is not None and len(window) > limit
+    window = window[:limit]
+    page = XmlNodes.node_id == top.node_id
+    if window and max_depth is None:
+        page = or_(page, and_(XmlNodes.doc_id == top.doc_id, XmlNodes.line.between(window[0].line, window[-1].last_line)))
+    elif window:
+        tree = select(XmlNodes.node_id, literal(1).label('depth')).where(XmlNodes.node_id.in_([child.node_id for child in window])).cte('window', recursive=True)
+        tree = tree.union_all(select(XmlNodes.node_id, tree.c.depth + 1).where(XmlNodes.parent_node == tree.c.node_id, tree.c.depth < max_depth))
+        page = or_(page, XmlNodes.node_id.in_(select(tree.c.node_id)))
+    entries = _node_entries(session, select(XmlNodes.node_id).where(page))
+    shown = entries if max_depth == 0 else entries[1:] # children of top are left out by the window
+    truncated = [entry['node_id'] for entry, following in zip(shown, shown[1:] + [None])
+                 if entry['has_children'] and (following is None or following['line'] != entry['line'] + 1)]
+    return {'xml': _tostring(_entries_tree(entries), declaration=False), 'node_id': top.node_id, 'line': top.line,
+            'offset': offset, 'limit': limit, 'children': len(window), 'truncated': truncated,
+            'next': dict(root_id=root_id, line_or_node_id={'node_id': top.node_id}, max_depth=max_depth,
+                         offset=offset + len(window), limit=limit) if more else None}
+
+@_instrumented
+def load_subtree(root_id, line_or_node_id, max_depth=None, offset=0, limit=None):
+    """This function returns part of the given xml(root_id) as dictionary, so big documents can
+    be read page by page:
+    - xml is the node with the selected children and their descendants, in load_xml format
+      without declaration
+    - node_id and line of the node, offset, limit and children (number of returned children)
+    - truncated are ids of returned nodes whose children were left out because of max_depth
+    - next are arguments of load_subtree(**next) which returns the next page, or None
+    line_or_node_id is line of the node or dictionary with node_id, like the ones returned
+    by load_node. max_depth limits levels below the node (0 returns only the node), offset
+    and limit select window of its children, limit must be positive."""
+    with Session(get_engine()) as session:
+        return _load_subtree(session, root_id, line_or_node_id, max_depth, offset, limit)
 
+def _escape_attribute(value):
+    """This is internal function which escapes attribute value like ElementTree does."""
+    return escape(value, {'"': '&quot;', '\r': '&#13;', '\n': '&#10;', '\t': '&#09;'})
+
+class _XmlWriter:
+    """Serializer of complete subtree given by node entries in document order, entries can be
+    written in batches. Joined chunks are equal to _tostring of the subtree. Element without
+    text is empty when its last_line is its line."""
+    def __init__(self, declaration=True, chunk_size=65536):
+        self.parts = ["<?xml version='1.0' encoding='utf8'?>\n"] if declaration else []
+        self.size = 0
+        self.chunk_size = chunk_size
+        self.stack = [] # (name, last_line) of open elements
+        self.after_tag = False # tags are separated by new line
+
+    def _close(self, line=None):
+        while self.stack and (line is None or line > self.stack[-1][1]):
+            self.parts.append(f'\n</{self.stack.pop()[0]}>' if self.after_tag else f'</{self.stack.pop()[0]}>')
+            self.size += len(self.parts[-1])
+            self.after_tag = True
+
+    def write(self, entries):
+        """Adds entries, yields chunks of about chunk_size characters when they are ready."""
+        for entry in entries:
+            self._close(entry['line'])
+            attributes = ''.join(f' {key}="{_escape_attribute(value)}"' for key, value in entry['attributes'].items())
+            start = '\n<' if self.after_tag else '<'
+            if entry['text']:
+                self.parts.append(f"{start}{entry['name']}{attributes}>{escape(entry['text'])}")
+                self.stack.append((entry['name'], entry['last_line']))
+            elif entry['last_line'] > entry['line']:
+                self.parts.append(f"{start}{entry['name']}{attributes}>")
+                self.stack.append((entry['name'], entry['last_line']))
+            else:
+                self.parts.append(f"{start}{entry['name']}{attributes} />")
+            self.after_tag = not entry['text']
+            self.size += len(self.parts[-1])
+            if self.size >= self.chunk_size:
+                yield ''.join(self.parts)
+                self.parts, self.size = [], 0
+
+    def close(self):
+        """Closes open elements and returns the last chunk."""
+        self._close()
+        return ''.join(self.parts)
+
+def _qualified_names(session, doc_id):
+    """This is internal function which checks if the document uses names with namespace
+    ({uri}name), those are serialized by ElementTree which assigns their prefixes."""
+    ids = session.scalars(select(XmlNames.id).where(XmlNames.name.startswith('{'))).all()
+    if not ids:
+        return False
+    return session.scalar(select(or_(exists().where(XmlNodes.doc_id == doc_id, XmlNodes.name_id.in_(ids)),
+                                     exists().where(XmlAttribute.doc_id == doc_id, XmlAttribute.key_id.in_(ids)))))
+
+def _next_entries(session, top, line, batch_size):
+    """This is internal function which returns entries of next batch_size nodes of subtree of
+    top behind the given line, in document order."""
+    batch = select(XmlNodes.node_id).where(XmlNodes.doc_id == top.doc_id, XmlNodes.line > line,
+                                           XmlNodes.line <= top.last_line).order_by(XmlNodes.line).limit(batch_size)
+    return _node_entries(session, batch)
+
+def iter_xml(root_id, line_or_node_id=1, batch_size=STREAM_BATCH_SIZE, chunk_size=65536):
+    """This function yields xml of the given document(root_id), or of subtree of the node given
+    by line or dictionary with node_id, in chunks of about chunk_size characters. Nodes are read
+    batch_size at once, so memory does not grow with the document. Joined chunks are equal to
+    load_xml (whole document) or to xml of load_subtree without limits (subtree, which has no
+    declaration). All batches are read in one transaction."""
+    with Session(get_engine()) as session:
+        top = _resolve_node(session, root_id, line_or_node_id)
+        if _qualified_names(session, top.doc_id):
+            element = _load_tree(session, top.node_id, root_only=top.parent_node is None)[0]
+            yield _tostring(element, declaration=top.parent_node is None)
+            return
+        writer, line = _XmlWriter(top.parent_node is None, chunk_size), top.line - 1
+        while line < top.last_line:
+            state = _start_operation('xml_orm.iter_xml') # statistics are collected per batch
+            try:
+                entries = _next_entries(session, top, line, batch_size)
+            finally:
+                _finish_operation(state)
+            if not entries:
+                break
+            yield from writer.write(entries)
+            line = entries[-1]['line']
+        yield writer.close()
+
+def _update_node(session, node, pair):
+    """This is internal function which sets value of attribute key=value of the node."""
+    key, value = pair.split("=")
+    key_id = select(XmlNames.id).where(XmlNames.name == key).scalar_subquery()
+    attrib = session.query(XmlAttribute).filter(XmlAttribute.node_id == node.node_id, XmlAttribute.key_id == key_id).first()
+    attrib.value = _stored_value(key, value)
+    session.flush()
+
+def _update_node_value(session, root_id, line_num, pair):
+    """This is internal function which sets value of attribute in the given line."""
+    _update_node(session, _node_at_line(session, root_id, line_num), pair)
+
+@_instrumented
 def update_node_value(root_id, line_num, pair):
     """This function searches for equal key in specified line(line_num) in the given xml(root_id)."""
-    key, value = pair.split("=")
-    with Session(engine) as session:
-        attrib = session.query(XmlAttribute).filter(XmlAttribute.node_id == get_id_by_line_number(line_num, root_id), XmlAttribute.key == key).first()
-        attrib.value = value
-        session.commit()
+    with Session(get_engine(write=True)) as session:
+        _update_node_value(session, root_id, line_num, pair)
+        _commit(session)
+    _invalidate(root_id)
+
+def _add_sub_xml(session, root_id, line_num, node, bulk=True, position=None):
+    """This is internal function which saves parsed node as child of node in the given line,
+    see _add_child."""
+    return _add_child(session, _node_at_line(session, root_id, line_num), node, bulk, position)
 
-def add_sub_xml(root_id, line_num, xml):
-    """This function adds xml as the child of node in the given line."""
+def _add_child(session, parent, node, bulk=True, position=None):
+    """This is internal function which saves parsed node as child of parent at position (None
+    for the last child), it returns written rows (None for ORM path)."""
+    root_id = parent.doc_id
+    order, line = _sibling_slot(session, parent, position)
+    _shift_lines(session, root_id, parent.line, line - 1, sum(1 for _ in node.iter()))
+    if bulk:
+        return _bulk_save(session, node, parent.node_id, order, root_id, line)[1]
+    ids = _intern(session, {node.tag, '__text__', *node.keys()})
+    new_node = XmlNodes(name_id=ids[node.tag], parent_node=parent.node_id, order=order, doc_id=root_id, line=line)
+    session.add(new_node)
+    session.flush()
+    if node.text and node.text.strip() != '':
+        new_text = XmlAttribute(node_id=new_node.node_id, key_id=ids['__text__'], value=_stored_value('__text__', node.text), doc_id=root_id)
+        session.add(new_text)
+
+    for attribute in node.items():
+        new_attr = XmlAttribute(node_id=new_node.node_id, key_id=ids[attribute[0]], value=attribute[1], doc_id=root_id)
+        session.add(new_attr)
+    next_line = [line+1]
+    _save_node(session, node, new_node.node_id, root_id, next_line)
+    new_node.last_line = next_line[0] - 1
+    session.flush()
+
+@_instrumented
+def add_sub_xml(root_id, line_num, xml, bulk=True, position=None):
+    """This function adds xml as the child of node in the given line.
+    - bulk works the same as in save_xml
+    - position is position of the new child counted from 1, by default it is the last child"""
     node = ElementTree.fromstring(xml)
-    parent_id = get_id_by_line_number(line_num, root_id)
-    with Session(engine) as session:
-        child_count = session.query(XmlNodes).filter(XmlNodes.parent_node == parent_id).count()
-        new_node = XmlNodes(name=node.tag, parent_node=parent_id, order=child_count+1)
-        session.add(new_node)
-        session.flush()
-        if node.text and node.text.strip() != '':
-            new_text = XmlAttribute(node_id=new_node.node_id, key='__text__', value=node.text)
-            session.add(new_text)
-        
-        for attribute in node.items():
-            new_attr = XmlAttribute(node_id=new_node.node_id, key=attribute[0], value=attribute[1])
-            session.add(new_attr)
-        _save_node(session, node, new_node.node_id)
-        try:
-            session.commit()
-        except exc.SQLAlchemyError:
-            session.rollback() # there were changes in database
+    with Session(get_engine(write=True)) as session:
+        started = time.perf_counter()
+        written = _add_sub_xml(session, root_id, line_num, node, bulk, position)
+        _commit(session)
+    _invalidate(root_id)
+    if bulk:
+        _report_bulk(written, started)
+
+def _change_node_order(session, root_id, line_num, target_position):
+    """This is internal function which swaps node in the given line with its sibling."""
+    _swap_node(session, _node_at_line(session, root_id, line_num), target_position)
 
+def _swap_node(session, a, target_position):
+    """This is internal function which swaps node with its sibling at target_position."""
+    target_position = int(target_position)
+    if target_position < 1:
+        raise Exception()
+    b = session.query(XmlNodes).filter(XmlNodes.parent_node == a.parent_node).order_by(XmlNodes.order).offset(target_position - 1).first()
+    a.order, b.order = b.order, a.order
+    session.flush()
+    first, second = sorted((a, b), key=lambda node: node.line)
+    first_size, second_size = first.last_line - first.line, second.last_line - second.line
+    _shift_blocks(session, a.doc_id, [(second.line, second.last_line, first.line - second.line),
+                                      (first.line, first.last_line, second.last_line - first.last_line)],
+                  (first.last_line + 1, second.line - 1, second_size - first_size))
+
+@_instrumented
 def change_node_order(root_id, line_num, target_position):
     """This function allows to change order of node
     - root_id is id of xml root node
     - line_num is the line where is the node which will change position
     - target_position is number of the position to change on"""
-    target_position = int(target_position)
-    if target_position < 1:
-        raise Exception()
-    node_id = get_id_by_line_number(line_num, root_id)
-    with Session(engine) as session:
-        a = session.query(XmlNodes).filter(XmlNodes.node_id == node_id).first()
-        b = session.query(XmlNodes).filter(XmlNodes.parent_node == a.parent_node, XmlNodes.order == target_position).first()
-        b.order = a.order
-        a.order = target_position
-        session.commit()
+    with Session(get_engine(write=True)) as session:
+        _change_node_order(session, root_id, line_num, target_position)
+        _commit(session)
+    _invalidate(root_id)
+
+def _move_node(session, root_id, line_num, position):
+    """This is internal function which moves node in the given line, see _move."""
+    _move(session, _node_at_line(session, root_id, line_num), position)
+
+def _move(session, node, position):
+    """This is internal function which moves node to position among its siblings, only order
+    of the node is changed. Lines of the subtree and of the nodes between its old and new
+    place are shifted by range updates."""
+    if node.parent_node is None:
+        raise ValueError("Root node can not be moved")
+    parent = session.get(XmlNodes, node.parent_node)
+    node.order, line = _sibling_slot(session, parent, position, node.node_id)
+    session.flush()
+    size = node.last_line - node.line + 1
+    if line > node.last_line: # forward, the node ends before the line
+        _shift_blocks(session, node.doc_id, [(node.line, node.last_line, line - 1 - node.last_line)], (node.last_line + 1, line - 1, -size))
+    else:
+        _shift_blocks(session, node.doc_id, [(node.line, node.last_line, line - node.line)], (line, node.line - 1, size))
+
+@_instrumented
+def move_node(root_id, line_num, position):
+    """This function moves node in the given line with its descendants to position among its
+    siblings, other siblings keep their order.
+    - position is counted from 1, position behind the last child moves the node to the end"""
+    with Session(get_engine(write=True)) as session:
+        _move_node(session, root_id, line_num, position)
+        _commit(session)
+    _invalidate(root_id)
+
+_EDITS = {
+    'update_node_value': _update_node,
+    'add_sub_xml': _add_child,
+    'change_node_order': _swap_node,
+    'move_node': _move,
+    'delete_subtree': _delete_subtree,
+}
+
+def _parse_edits(edits):
+    """This is internal function which checks edits and parses xml of added nodes, it returns
+    list of (name, line, arguments)."""
+    parsed = []
+    for name, line, *arguments in edits:
+        if name not in _EDITS:
+            raise ValueError(f"Unknown edit {name}")
+        if name == 'add_sub_xml':
+            arguments[0] = ElementTree.fromstring(arguments[0])
+        parsed.append((name, int(line), arguments))
+    return parsed
+
+def _apply_edits(session, root_id, edits):
+    """This is internal function which applies parsed edits to the document. All lines are
+    resolved to nodes by one query before the first edit, so every line means the line of
+    the document before the batch."""
+    lines = {line for _, line, _ in edits}
+    nodes = dict(session.execute(select(XmlNodes.line, XmlNodes.node_id).where(XmlNodes.doc_id == root_id, XmlNodes.line.in_(lines))).all())
+    for name, line, arguments in edits:
+        if line not in nodes:
+            raise ValueError(f"Line {line} is not in the document")
+        node = session.get(XmlNodes, nodes[line])
+        if node is None:
+            raise ValueError(f"Node in line {line} was deleted by previous edit")
+        _EDITS[name](session, node, *arguments)
+        session.flush()
+        session.expire_all() # lines were changed by set based statements
+
+@_instrumented
+def apply_edits(root_id, edits):
+    """This function applies many edits to the given xml(root_id) in one transaction, they are
+    all applied or none of them. Edits are tuples (function name, line, other arguments of the
+    function), for example ('update_node_value', 3, 'id=2'), ('add_sub_xml', 1, '<a/>', True, 1),
+    ('change_node_order', 2, 1), ('move_node', 4, 1) or ('delete_subtree', 5). Every line is the
+    line of the document before the batch, so edits do not change meaning of following lines."""
+    edits = _parse_edits(edits)
+    with Session(get_engine(write=True)) as session:
+        _apply_edits(session, root_id, edits)
+        _commit(session)
+    _invalidate(root_id)
+
+class DocumentEdit:
+    """Collects edits of one document and applies them by apply_edits when the with block
+    ends without exception. Methods have the same arguments as the functions without root_id.
+        with xml_orm.edit(root_id) as doc:
+            doc.update_node_value(3, 'id=2')
+            doc.add_sub_xml(1, '<a/>', position=1)
+            doc.delete_subtree(5)"""
+    def __init__(self, root_id):
+        self.root_id = root_id
+        self.edits = []
+
+    def update_node_value(self, line_num, pair):
+        self.edits.append(('update_node_value', line_num, pair))
+
+    def add_sub_xml(self, line_num, xml, bulk=True, position=None):
+        self.edits.append(('add_sub_xml', line_num, xml, bulk, position))
+
+    def change_node_order(self, line_num, target_position):
+        self.edits.append(('change_node_order', line_num, target_position))
+
+    def move_node(self, line_num, position):
+        self.edits.append(('move_node', line_num, position))
+
+    def delete_subtree(self, line_num):
+        self.edits.append(('delete_subtree', line_num))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.edits:
+            apply_edits(self.root_id, self.edits)
+
+def edit(root_id):
+    """This function returns DocumentEdit context manager which applies edits of the given
+    xml(root_id) in one transaction at the end of with block."""
+    return DocumentEdit(root_id)
+
+def _full_text_enabled(connection):
+    """This is internal function which checks if full text index exists."""
+    return inspect(connection).has_table(FULL_TEXT_TABLE)
+
+@_instrumented
+def enable_full_text_search():
+    """This function creates SQLite FTS5 index over values of XmlAttributes (attributes and
+    __text__), which is used by find_node_with_value with mode='fulltext'. Index is kept up to
+    date by triggers, so it slows down saving. Existing values are indexed."""
+    with get_engine(write=True).begin() as connection:
+        _enable_full_text_search(connection)
+
+def _enable_full_text_search(connection):
+    """This is internal function which creates full text index and its triggers."""
+    if _full_text_enabled(connection):
+        return
+    connection.execute(text(f'CREATE VIRTUAL TABLE "{FULL_TEXT_TABLE}" USING fts5(value, content=\'XmlAttributes\', content_rowid=\'id\')'))
+    # compressed values (blobs) are not indexed
+    connection.execute(text(f'''CREATE TRIGGER "{FULL_TEXT_TABLE}_insert" AFTER INSERT ON "XmlAttributes" BEGIN
+        INSERT INTO "{FULL_TEXT_TABLE}"(rowid, value) SELECT new.id, new.value WHERE typeof(new.value) = 'text'; END'''))
+    connection.execute(text(f'''CREATE TRIGGER "{FULL_TEXT_TABLE}_delete" AFTER DELETE ON "XmlAttributes" BEGIN
+        INSERT INTO "{FULL_TEXT_TABLE}"("{FULL_TEXT_TABLE}", rowid, value) SELECT 'delete', old.id, old.value WHERE typeof(old.value) = 'text'; END'''))
+    connection.execute(text(f'''CREATE TRIGGER "{FULL_TEXT_TABLE}_update" AFTER UPDATE ON "XmlAttributes" BEGIN
+        INSERT INTO "{FULL_TEXT_TABLE}"("{FULL_TEXT_TABLE}", rowid, value) SELECT 'delete', old.id, old.value WHERE typeof(old.value) = 'text';
+        INSERT INTO "{FULL_TEXT_TABLE}"(rowid, value) SELECT new.id, new.value WHERE typeof(new.value) = 'text'; END'''))
+    connection.execute(text(f'''INSERT INTO "{FULL_TEXT_TABLE}"(rowid, value) SELECT id, value FROM "XmlAttributes" WHERE typeof(value) = 'text' '''))
+
+@_instrumented
+def disable_full_text_search():
+    """This function drops full text index created by enable_full_text_search."""
+    with get_engine(write=True).begin() as connection:
+        _disable_full_text_search(connection)
+
+def _disable_full_text_search(connection):
+    """This is internal function which drops full text index and its triggers."""
+    connection.execute(text(f'DROP TABLE IF EXISTS "{FULL_TEXT_TABLE}"'))
+    for trigger in ('insert', 'delete', 'update'):
+        connection.execute(text(f'DROP TRIGGER IF EXISTS "{FULL_TEXT_TABLE}_{trigger}"'))
+
+def _node_string(name, attributes, names):
+    """This is internal function which returns node without its children as string.
+    - attributes are (node_id, key_id, value) rows, names is dictionary id: name"""
+    attributes = [(names[curr.key_id], curr.value) for curr in attributes]
+    return f'<{name}'+ " ".join(["", *[key+'=\"'+value+"\"" for key, value in attributes if key != "__text__"]]) + f'>{str(*[_loaded_value(value) for key, value in attributes if key == "__text__"])}</{name}>'
+
+def _search_condition(find, mode):
+    """This is internal function which returns condition on XmlAttribute for the search mode."""
+    if mode == 'exact':
+        return XmlAttribute.value == find
+    if mode == 'substring':
+        escaped = str(find).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        return XmlAttribute.value.like(f'%{escaped}%', escape='\\')
+    if mode == 'fulltext':
+        return XmlAttribute.id.in_(text(f'SELECT rowid FROM "{FULL_TEXT_TABLE}" WHERE "{FULL_TEXT_TABLE}" MATCH :find')
+                                   .bindparams(find=str(find)).columns(rowid=Integer))
+    raise ValueError(f"Unknown search mode {mode}")
+
+@_instrumented
+def find_node_with_value(root_id, find, mode='exact', offset=0, limit=None):
+    """This function searches for the value(find) in specified xml document(root_id).
+    It returns nodes (without children) in document order, every node at most once.
+    - mode is 'exact' for equal values, 'substring' for values containing find or 'fulltext'
+      for FTS5 query (tokens, prefixes like 'rain*'), which needs enable_full_text_search
+    - offset and limit select page of results"""
+    condition = _search_condition(find, mode)
+    with Session(get_engine()) as session:
+        return _find_node_with_value(session, root_id, condition, offset, limit)
+
+def _find_node_with_value(session, root_id, condition, offset, limit):
+    """This is internal function which returns page of nodes having attribute which meets
+    condition."""
+    hits = select(XmlAttribute.node_id).where(XmlAttribute.doc_id == root_id, condition)
+    page = select(XmlNodes.node_id).where(XmlNodes.node_id.in_(hits)).order_by(XmlNodes.line).offset(offset).limit(limit)
+    found = session.execute(page.add_columns(XmlNodes.name_id)).all()
+    attributes, names = {}, _NameLookup(session)
+    for attrib in session.execute(select(XmlAttribute.node_id, XmlAttribute.key_id, XmlAttribute.value)
+                                  .where(XmlAttribute.node_id.in_(page)).order_by(XmlAttribute.id)).all():
+        attributes.setdefault(attrib.node_id, []).append(attrib)
+    return [_node_string(names[node.name_id], attributes[node.node_id], names) for node in found]
+
+
+_XPATH_STEP = re.compile(r"(//|/)?([^\W\d][\w.:-]*|\*)") # names start with letter or underscore, so . and .. are rejected
+_XPATH_PREDICATE = re.compile(r"""\[\s*(?:@([^\W\d][\w.:-]*)\s*(?:=\s*(?:'([^']*)'|"([^"]*)"))?|text\(\)\s*=\s*(?:'([^']*)'|"([^"]*)")|(\d+))\s*\]""")
+
+def _parse_xpath(xpath):
+    """This is internal function which splits xpath into steps (axis, name, predicates).
+    Predicate is ('attribute', key, value or None) or ('position', number)."""
+    steps, position = [], 0
+    xpath = xpath.strip()
+    while position < len(xpath):
+        step = _XPATH_STEP.match(xpath, position)
+        if not step or (steps and not step.group(1)):
+            raise ValueError(f"Unsupported xpath {xpath} at position {position}")
+        position = step.end()
+        predicates = []
+        while predicate := _XPATH_PREDICATE.match(xpath, position):
+            attribute, single, double, text_single, text_double, number = predicate.groups()
+            if number:
+                predicates.append(('position', int(number)))
+            elif attribute:
+                predicates.append(('attribute', attribute, single if single is not None else double))
+            else:
+                predicates.append(('attribute', '__text__', text_single if text_single is not None else text_double))
+            position = predicate.end()
+        steps.append(('descendant' if step.group(1) == '//' else 'child', step.group(2), predicates))
+    if not steps:
+        raise ValueError("Empty xpath")
+    return steps, xpath.startswith('/')
+
+def _xpath_step(root_id, context, axis, name, predicates):
+    """This is internal function which compiles one xpath step into SQL subquery with
+    (node_id, line, last_line, parent_node, order) of matching nodes.
+    - context is subquery of the previous step, None is the document node"""
+    nodes = XmlNodes.__table__.alias()
+    query = select(nodes.c.node_id, nodes.c.line, nodes.c.last_line, nodes.c.parent_node, nodes.c.order).where(nodes.c.doc_id == root_id)
+    if name != '*':
+        query = query.where(nodes.c.name_id == select(XmlNames.id).where(XmlNames.name == name).scalar_subquery())
+    if context is None:
+        if axis == 'child':
+            query = query.where(nodes.c.node_id == root_id)
+    elif axis == 'child':
+        query = query.join(context, nodes.c.parent_node == context.c.node_id)
+    else:
+        query = query.join(context, and_(nodes.c.line > context.c.line, nodes.c.line <= context.c.last_line)).distinct()
+
+    for predicate in predicates:
+        current = query.subquery()
+        if predicate[0] == 'position':
+            ranked = select(current, func.row_number().over(partition_by=current.c.parent_node, order_by=current.c.order).label('position')).subquery()
+            query = select(ranked.c.node_id, ranked.c.line, ranked.c.last_line, ranked.c.parent_node, ranked.c.order).where(ranked.c.position == predicate[1])
+        else:
+            _, key, value = predicate
+            attributes = XmlAttribute.__table__.alias()
+            key_id = select(XmlNames.id).where(XmlNames.name == key).scalar_subquery()
+            condition = select(attributes.c.id).where(attributes.c.node_id == current.c.node_id, attributes.c.key_id == key_id)
+            if value is not None:
+                condition = condition.where(attributes.c.value == value)
+            query = select(current).where(condition.exists())
+    return query.subquery()
+
+def _query_xml(session, root_id, xpath, subtree=True):
+    """This is internal function which executes query_xml."""
+    steps, absolute = _parse_xpath(xpath)
+    context = None
+    if not absolute:
+        context = select(XmlNodes.node_id, XmlNodes.line, XmlNodes.last_line).where(XmlNodes.node_id == root_id).subquery()
+    for axis, name, predicates in steps:
+        context = _xpath_step(root_id, context, axis, name, predicates)
+
+    if not subtree:
+        found = session.execute(select(XmlNodes.node_id, XmlNodes.name_id).join(context, XmlNodes.node_id == context.c.node_id)
+                                .order_by(XmlNodes.line)).all()
+        attributes, names = {}, _NameLookup(session)
+        for attrib in session.execute(select(XmlAttribute.node_id, XmlAttribute.key_id, XmlAttribute.value)
+                                      .where(XmlAttribute.node_id.in_(select(context.c.node_id))).order_by(XmlAttribute.id)).all():
+            attributes.setdefault(attrib.node_id, []).append(attrib)
+        return [_node_string(names[node.name_id], attributes.get(node.node_id, []), names) for node in found]
+
+    in_match = and_(XmlNodes.doc_id == root_id, XmlNodes.line.between(context.c.line, context.c.last_line))
+    nodes = session.execute(select(context.c.node_id.label('match_id'), context.c.line.label('match_line'), XmlNodes.node_id,
+                                   XmlNodes.name_id, XmlNodes.parent_node, XmlNodes.order).join(context, in_match)).all()
+    attributes = session.execute(select(context.c.node_id.label('match_id'), XmlAttribute.node_id, XmlAttribute.key_id, XmlAttribute.value)
+                                 .join(XmlNodes, XmlNodes.node_id == XmlAttribute.node_id).join(context, in_match)
+                                 .order_by(XmlAttribute.id)).all()
+    matches, match_attributes = {}, {}
+    for node in nodes:
+        matches.setdefault((node.match_line, node.match_id), []).append(node)
+    for attrib in attributes:
+        match_attributes.setdefault(attrib.match_id, []).append(attrib)
+    names = _NameLookup(session)
+    return [_tostring(_build_tree(matches[match], match_attributes.get(match[1], []), match[1], names), declaration=False)
+            for match in sorted(matches)]
 
-def find_node_with_value(root_id, find):
-    """This function searches for the value(find) in specified xml document(root_id)."""
-    nodes = ''
-    with Session(engine) as session:
-        attribiutes = session.query(XmlAttribute).filter(XmlAttribute.value == find).all()
-        nodes = []
-        for attrib in attribiutes:
-            node = session.query(XmlNodes).filter(XmlNodes.node_id == attrib.node_id).first()
-            curr_attrib = session.query(XmlAttribute).filter(XmlAttribute.node_id == node.node_id).all()
-            nodes.append(f'<{node.name}'+ " ".join(["", *[curr.key+'=\"'+curr.value+"\"" for curr in curr_attrib if curr.key != "__text__"]]) + f'>{str(*[curr.value for curr in curr_attrib if curr.key == "__text__"])}</{node.name}>')
-    return nodes
\ No newline at end of file
+@_instrumented
+def query_xml(root_id, xpath, subtree=True):
+    """This function returns nodes of the given xml(root_id) which match xpath, in document order.
+    The query is executed by database, so the document is not loaded. Supported are absolute
+    and relative (to the root node) paths with child (/) and descendant (//) steps, name
+    tests (name or *) and predicates [@key], [@key='value'], [text()='value'] and [position].
+    - subtree selects if the matching nodes are returned with their descendants (in the format
+      of load_xml without declaration) or without them (like find_node_with_value)
+    It throws ValueError for unsupported xpath."""
+    with Session(get_engine()) as session:
+        return _query_xml(session, root_id, xpath, subtree)
@@ -0,0 +1,253 @@
+"""Asynchronous version of xml_orm for asyncio applications.
+
+Functions have the same names, arguments and results as in xml_orm, but they are
+coroutines. Database is accessed by SQLAlchemy async engine with aiosqlite driver, so
+waiting for the database does not block the event loop and many reads run concurrently.
+Database url and SQLite pragmas are taken from xml_orm.configure, document cache of
+xml_orm (enable_cache) is shared by both modules.
+
+    root_id = await xml_orm_async.save_xml('<root><node>value</node></root>')
+    xml = await xml_orm_async.load_xml(root_id)
+"""
+from sqlalchemy import event, exc
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from xml.etree import ElementTree
+import functools, time
+import xml_orm
+
+_engines = None
+
+
+def _async_url(url):
+    """This is internal function which selects aiosqlite driver for the database url."""
+    if url.startswith('sqlite:'):
+        return 'sqlite+aiosqlite:' + url[len('sqlite:'):]
+    return url
+
+async def _create_engines(settings):
+    """This is internal function which creates async engine for the settings and prepares the
+    database. It returns (reading engine, writing engine, settings)."""
+    engine = create_async_engine(_async_url(settings['url']), pool_size=settings['pool_size'],
+                                 connect_args={'timeout': settings['busy_timeout']})
+    event.listen(engine.sync_engine, 'connect', xml_orm._sqlite_connect)
+    event.listen(engine.sync_engine, 'begin', xml_orm._sqlite_begin)
+    xml_orm._instrument_engine(engine.sync_engine)
+    writer = engine.execution_options(xml_orm_write=True)
+    async with engine.connect() as connection:
+        current = await connection.run_sync(xml_orm._schema_current)
+    if not current:
+        async with writer.begin() as connection:
+            await connection.run_sync(xml_orm._prepare_database)
+    return engine, writer, settings
+
+async def get_engine(write=False):
+    """This function returns async engine of the database configured by xml_orm.configure,
+    it is created on first use and after the configuration changes. Engine is bound to the
+    running event loop, call dispose before the loop is closed.
+    - write selects engine whose transactions take the write lock at start"""
+    global _engines
+    settings = dict(xml_orm._settings)
+    if _engines is None or _engines[2] != settings:
+        engines = await _create_engines(settings)
+        if _engines is not None and _engines[2] == settings: # created by concurrent call
+            await engines[0].dispose()
+        else:
+            if _engines is not None:
+                await _engines[0].dispose()
+            _engines = engines
+    return _engines[1] if write else _engines[0]
+
+async def dispose():
+    """This function closes connections of the async engine."""
+    global _engines
+    if _engines is not None:
+        await _engines[0].dispose()
+        _engines = None
+
+def _instrumented(function):
+    """This is internal decorator which collects statistics of public coroutine, see
+    xml_orm.enable_stats."""
+    name = f'{function.__module__}.{function.__name__}'
+    @functools.wraps(function)
+    async def wrapper(*args, **kwargs):
+        state = xml_orm._start_operation(name)
+        try:
+            return await function(*args, **kwargs)
+        finally:
+            xml_orm._finish_operation(state)
+    return wrapper
+
+async def _run(write, function, *args):
+    """This is internal function which calls internal function of xml_orm with session bound
+    to async connection, writing session is committed."""
+    async with AsyncSession(await get_engine(write)) as session:
+        result = await session.run_sync(function, *args)
+        if write:
+            try:
+                await session.commit()
+            except exc.SQLAlchemyError:
+                await session.rollback() # there were changes in database
+                raise
+    return result
+
+@_instrumented
+async def drop_data():
+    """This function allows to clear all tables in database, see xml_orm.drop_data."""
+    async with (await get_engine(write=True)).begin() as connection:
+        await connection.run_sync(xml_orm._drop_data)
+    xml_orm._invalidate()
+
+@_instrumented
+async def save_xml(xml, bulk=True):
+    """This function saves xml document into database, see xml_orm.save_xml."""
+    root = ElementTree.fromstring(xml)
+    started = time.perf_counter()
+    root_id, written = await _run(True, xml_orm._save_xml, root, bulk)
+    xml_orm._invalidate(root_id)
+    if bulk:
+        xml_orm._report_bulk(written, started)
+    return root_id
+
+@_instrumented
+async def save_xml_file(source):
+    """This function saves xml document from file, see xml_orm.save_xml_file. The file is read
+    in small chunks between the database writes."""
+    started = time.perf_counter()
+    root_id, written = await _run(True, xml_orm._save_xml_file, source)
+    xml_orm._invalidate(root_id)
+    xml_orm._report_bulk(written, started)
+    return root_id
+
+async def _document(id):
+    """This is internal function which returns (xml, dictionary line: node_id) of document
+    from the cache or from database."""
+    cache = xml_orm._cache
+    if not cache:
+        return await _run(False, xml_orm._load_document, id)
+    entry, epoch = cache.get(id)
+    if entry is None:
+        entry = await _run(False, xml_orm._load_document, id)
+        cache.put(id, entry, epoch)
+    return entry
+
+@_instrumented
+async def load_xml(id):
+    """This function returns xml document, see xml_orm.load_xml."""
+    return (await _document(id))[0]
+
+@_instrumented
+async def available_xml():
+    """This function returns name and id of all xml documents in database"""
+    return await _run(False, xml_orm._available_xml)
+
+@_instrumented
+async def get_id_by_line_number(line, root_id):
+    """This function returns node id which is correlated with line, see
+    xml_orm.get_id_by_line_number."""
+    entry = xml_orm._cache.get(root_id)[0] if xml_orm._cache else None
+    if entry is not None:
+        return entry[1].get(int(line))
+    return await _run(False, xml_orm._line_to_id, root_id, line)
+
+@_instrumented
+async def delete_xml(id):
+    """This function deletes xml document from database by the given root node id."""
+    doc_id = await _run(True, xml_orm._delete_xml, id)
+    xml_orm._invalidate(doc_id)
+
+@_instrumented
+async def delete_subtree(root_id, line_num):
+    """This function deletes node in the given line with all its descendants."""
+    await _run(True, xml_orm._delete_line, root_id, line_num)
+    xml_orm._invalidate(root_id)
+
+@_instrumented
+async def get_line_number(node_id):
+    """This function returns line of the node in its document, see xml_orm.get_line_number."""
+    return await _run(False, xml_orm._node_line, node_id)
+
+@_instrumented
+async def load_node(node_id):
+    """This function returns node without its children as dictionary, see xml_orm.load_node."""
+    return await _run(False, xml_orm._load_node, node_id)
+
+@_instrumented
+async def load_children(node_id, offset=0, limit=None):
+    """This function returns page of children of node, see xml_orm.load_children."""
+    return await _run(False, xml_orm._load_children, node_id, offset, limit)
+
+@_instrumented
+async def load_subtree(root_id, line_or_node_id, max_depth=None, offset=0, limit=None):
+    """This function returns page of subtree of the given xml(root_id), see xml_orm.load_subtree."""
+    return await _run(False, xml_orm._load_subtree, root_id, line_or_node_id, max_depth, offset, limit)
+
+async def iter_xml(root_id, line_or_node_id=1, batch_size=xml_orm.STREAM_BATCH_SIZE, chunk_size=65536):
+    """This async generator yields xml of the given document(root_id) or subtree in chunks, see
+    xml_orm.iter_xml. Every batch of nodes is read by one await in the same transaction."""
+    async with AsyncSession(await get_engine()) as session:
+        top = await session.run_sync(xml_orm._resolve_node, root_id, line_or_node_id)
+        declaration = top.parent_node is None
+        if await session.run_sync(xml_orm._qualified_names, top.doc_id):
+            element = (await session.run_sync(xml_orm._load_tree, top.node_id, declaration))[0]
+            yield xml_orm._tostring(element, declaration)
+            return
+        writer, line = xml_orm._XmlWriter(declaration, chunk_size), top.line - 1
+        while line < top.last_line:
+            state = xml_orm._start_operation('xml_orm_async.iter_xml') # statistics are collected per batch
+            try:
+                entries = await session.run_sync(xml_orm._next_entries, top, line, batch_size)
+            finally:
+                xml_orm._finish_operation(state)
+            if not entries:
+                break
+            for chunk in writer.write(entries):
+                yield chunk
+            line = entries[-1]['line']
+        yield writer.close()
+
+@_instrumented
+async def update_node_value(root_id, line_num, pair):
+    """This function searches for equal key in specified line(line_num) in the given xml(root_id)."""
+    await _run(True, xml_orm._update_node_value, root_id, line_num, pair)
+    xml_orm._invalidate(root_id)
+
+@_instrumented
+async def add_sub_xml(root_id, line_num, xml, bulk=True, position=None):
+    """This function adds xml as the child of node in the given line, see xml_orm.add_sub_xml."""
+    node = ElementTree.fromstring(xml)
+    started = time.perf_counter()
+    written = await _run(True, xml_orm._add_sub_xml, root_id, line_num, node, bulk, position)
+    xml_orm._invalidate(root_id)
+    if bulk:
+        xml_orm._report_bulk(written, started)
+
+@_instrumented
+async def change_node_order(root_id, line_num, target_position):
+    """This function allows to change order of node, see xml_orm.change_node_order."""
+    await _run(True, xml_orm._change_node_order, root_id, line_num, target_position)
+    xml_orm._invalidate(root_id)
+
+@_instrumented
+async def move_node(root_id, line_num, position):
+    """This function moves node in the given line to position among its siblings, see
+    xml_orm.move_node."""
+    await _run(True, xml_orm._move_node, root_id, line_num, position)
+    xml_orm._invalidate(root_id)
+
+@_instrumented
+async def apply_edits(root_id, edits):
+    """This function applies many edits in one transaction, see xml_orm.apply_edits."""
+    await _run(True, xml_orm._apply_edits, root_id, xml_orm._parse_edits(edits))
+    xml_orm._invalidate(root_id)
+
+@_instrumented
+async def find_node_with_value(root_id, find, mode='exact', offset=0, limit=None):
+    """This function searches for the value(find) in specified xml document(root_id), see
+    xml_orm.find_node_with_value."""
+    return await _run(False, xml_orm._find_node_with_value, root_id, xml_orm._search_condition(find, mode), offset, limit)
+
+@_instrumented
+async def query_xml(root_id, xpath, subtree=True):
+    """This function returns nodes of the given xml(root_id) which match xpath, see
+    xml_orm.query_xml."""
+    return await _run(False, xml_orm._query_xml, root_id, xpath, subtree)
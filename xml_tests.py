@@ -1,5 +1,16 @@
-import xml_orm
-import unittest
+import xml_orm, xml_orm_async, xml_import
+import unittest, unittest.mock, asyncio, io, os, subprocess, sys, tempfile, threading, time
+
+def killing_parse(path, parse_file=xml_import._parse_file):
+    # worker process dies like when it runs out of memory
+    if path.endswith('kill.xml'):
+        os._exit(1)
+    return parse_file(path)
+
+def failing_save(session, rows, save_rows=xml_import._save_rows):
+    if rows[0][0]['name'] == 'locked':
+        raise xml_orm.exc.OperationalError('INSERT', {}, Exception('database is locked'))
+    return save_rows(session, rows)
 
 class TestXMLMethods(unittest.TestCase):
     def setUp(self):
@@ -9,6 +20,13 @@ class TestXMLMethods(unittest.TestCase):
     def tearDownClass(self):
         xml_orm.drop_data()
 
+    def clear_names(self):
+        # drop_data keeps the dictionary of names
+        with xml_orm.Session(xml_orm.get_engine(write=True)) as session:
+            session.execute(xml_orm.delete(xml_orm.XmlNames))
+            session.commit()
+        xml_orm._forget_names()
+
     def test_clear_database(self):
         xml_orm.save_xml('<test></test>')
         xml_orm.drop_data()
@@ -19,6 +37,95 @@ class TestXMLMethods(unittest.TestCase):
         xml_orm.save_xml(xml_string)
         self.assertEqual(xml_string.replace(" ", "").replace("\n", "").replace("'", "\""), xml_orm.load_xml(xml_orm.available_xml()[0].node_id).replace(" ", "").replace("\n", "").replace("'", "\""))
 
+    def test_save_xml_bulk_matches_orm(self):
+        xml_string = '<root><person id="1" name="John"><age>30</age><gender>Male</gender></person><person id="2" name="Jane"><age>25</age><gender>Female</gender></person></root>'
+        xml_orm.save_xml(xml_string, bulk=False)
+        xml_orm.save_xml(xml_string, bulk=True)
+        orm_id, bulk_id = [node_id for node_id, _ in xml_orm.available_xml()]
+        self.assertEqual(xml_orm.load_xml(orm_id), xml_orm.load_xml(bulk_id))
+        self.assertEqual(xml_orm.get_id_by_line_number(3, bulk_id) - bulk_id, xml_orm.get_id_by_line_number(3, orm_id) - orm_id)
+        self.assertEqual(xml_orm.last_bulk_stats['rows'], 15)
+
+    def test_save_xml_file(self):
+        with open('example.xml', 'rb') as file:
+            xml_orm.save_xml(file.read())
+        root_id = xml_orm.save_xml_file('example.xml')
+        self.assertEqual(xml_orm.load_xml(1), xml_orm.load_xml(root_id))
+        self.assertEqual(xml_orm.get_id_by_line_number(10, 1) - 1, xml_orm.get_id_by_line_number(10, root_id) - root_id)
+
+    def test_save_xml_file_stream(self):
+        xml_orm.save_xml_file(io.BytesIO(b'<root a="1">text<b><c x="y"/></b><b/></root>'))
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root a="1">text<b><c x="y" /></b><b /></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+        with self.assertRaises(xml_orm.ElementTree.ParseError):
+            xml_orm.save_xml_file(io.BytesIO(b'<root><b></root>'))
+        self.assertEqual(len(xml_orm.available_xml()), 1)
+
+    def test_migrate_schema(self):
+        engine = xml_orm.create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute(xml_orm.text('CREATE TABLE "XmlNodes" (node_id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, parent_node INTEGER, "order" INTEGER NOT NULL)'))
+            connection.execute(xml_orm.text('CREATE TABLE "XmlAttributes" (id INTEGER PRIMARY KEY, node_id INTEGER, "key" VARCHAR NOT NULL, value VARCHAR NOT NULL)'))
+            connection.execute(xml_orm.text('INSERT INTO "XmlNodes" VALUES (1, "a", NULL, 1), (2, "b", 1, 1), (3, "c", 2, 1), (4, "d", NULL, 1)'))
+            connection.execute(xml_orm.text('INSERT INTO "XmlAttributes" VALUES (1, 3, "x", "1"), (2, 4, "y", "2")'))
+        xml_orm.migrate_schema(engine)
+        xml_orm.migrate_schema(engine)
+        with engine.connect() as connection:
+            self.assertEqual(connection.execute(xml_orm.text('SELECT node_id, doc_id, line, last_line FROM "XmlNodes" ORDER BY node_id')).all(),
+                             [(1, 1, 1, 3), (2, 1, 2, 3), (3, 1, 3, 3), (4, 4, 1, 1)])
+            self.assertEqual(connection.execute(xml_orm.text('SELECT id, doc_id FROM "XmlAttributes" ORDER BY id')).all(), [(1, 1), (2, 4)])
+            indexes = [index['name'] for index in xml_orm.inspect(connection).get_indexes('XmlAttributes')]
+            self.assertIn('ix_XmlAttributes_doc_id_value', indexes)
+            self.assertEqual(connection.execute(xml_orm.text('SELECT "XmlNames".name FROM "XmlNodes" JOIN "XmlNames" ON "XmlNames".id = name_id ORDER BY node_id')).scalars().all(), ['a', 'b', 'c', 'd'])
+            self.assertEqual(connection.execute(xml_orm.text('SELECT "XmlNames".name FROM "XmlAttributes" JOIN "XmlNames" ON "XmlNames".id = key_id ORDER BY "XmlAttributes".id')).scalars().all(), ['x', 'y'])
+            self.assertNotIn('name', [column['name'] for column in xml_orm.inspect(connection).get_columns('XmlNodes')])
+
+    def test_interned_names(self):
+        self.clear_names()
+        xml_orm.save_xml('<root><a x="1">t</a><a x="2">t</a></root>')
+        xml_orm.save_xml('<a x="3"><root/></a>')
+        with xml_orm.Session(xml_orm.engine) as session:
+            self.assertEqual(sorted(session.scalars(xml_orm.select(xml_orm.XmlNames.name))), ['__text__', 'a', 'root', 'x'])
+        self.assertEqual(xml_orm.available_xml(), [(1, 'root'), (4, 'a')])
+        xml_orm._forget_names() # names are loaded from database like in other process
+        self.assertEqual(xml_orm.load_xml(4).split('\n')[1:], ['<a x="3">', '<root />', '</a>'])
+        self.assertEqual(xml_orm.query_xml(1, "/root/a[@x='2']"), ['<a x="2">t</a>'])
+        with self.assertRaises(xml_orm.ElementTree.ParseError):
+            xml_orm.save_xml_file(io.BytesIO(b'<new><b></new>'))
+        with xml_orm.Session(xml_orm.engine) as session:
+            self.assertEqual(session.query(xml_orm.XmlNames).count(), 4)
+
+    def test_names_per_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            try:
+                xml_orm.configure(url=f'sqlite:///{os.path.join(directory, "a.db")}')
+                xml_orm.save_xml('<zzz><yyy k="1"/></zzz>')
+                xml_orm.configure(url=f'sqlite:///{os.path.join(directory, "b.db")}')
+                xml_orm.save_xml('<root><child/></root>')
+                root_id = xml_orm.save_xml('<zzz><yyy k="2"/></zzz>')
+                self.assertEqual(xml_orm.load_xml(root_id).split('\n')[1:], ['<zzz>', '<yyy k="2" />', '</zzz>'])
+                xml_orm.configure(url=f'sqlite:///{os.path.join(directory, "a.db")}')
+                self.assertEqual(xml_orm.load_xml(1).split('\n')[1:], ['<zzz>', '<yyy k="1" />', '</zzz>'])
+            finally:
+                xml_orm.configure(url='sqlite:///XML-database.db')
+
+    def test_compress_text(self):
+        xml_orm.configure(compress_text=20)
+        try:
+            long_text = 'long text ' * 10
+            xml_orm.save_xml(f'<root><a>short</a><b>{long_text}</b></root>')
+            xml_orm.add_sub_xml(1, 1, f'<c>{long_text}</c>', bulk=False)
+            xml_orm.update_node_value(1, 2, f'__text__={long_text}!')
+            with xml_orm.Session(xml_orm.engine) as session:
+                stored = session.scalars(xml_orm.select(xml_orm.XmlAttribute.value).order_by(xml_orm.XmlAttribute.id)).all()
+            self.assertEqual([isinstance(value, bytes) for value in stored], [True, True, True])
+            self.assertLess(len(stored[1]), len(long_text))
+            loaded = xml_orm.load_xml(1)
+            self.assertEqual(f'<root><a>{long_text}!</a><b>{long_text}</b><c>{long_text}</c></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+            self.assertEqual(xml_orm.query_xml(1, '/root/c', subtree=False), [f'<c>{long_text}</c>'])
+        finally:
+            xml_orm.configure(compress_text=None)
+
     def test_available_xml(self):
         xml_orm.save_xml('<node></node>')
         xml_orm.save_xml('<test></test>')
@@ -30,10 +137,57 @@ class TestXMLMethods(unittest.TestCase):
         xml_orm.delete_xml(1)
         self.assertEqual(xml_orm.available_xml(), [])
 
+    def test_delete_xml_keeps_other_documents(self):
+        xml_orm.save_xml('<root><a x="1"><b>text</b></a></root>')
+        xml_orm.save_xml('<other><c y="2"/></other>')
+        xml_orm.delete_xml(1)
+        self.assertEqual(xml_orm.available_xml(), [(4, 'other')])
+        self.assertEqual(xml_orm.load_xml(4).split('\n')[1:], ['<other>', '<c y="2" />', '</other>'])
+        with xml_orm.Session(xml_orm.engine) as session:
+            self.assertEqual(session.query(xml_orm.XmlAttribute).count(), 1)
+
+    def test_delete_subtree(self):
+        xml_orm.save_xml('<root><a x="1"><b>text</b></a><c><d/></c><e/></root>')
+        xml_orm.delete_subtree(1, 2)
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root><c><d /></c><e /></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+        self.assertLinesConsistent(1)
+        self.assertEqual(xml_orm.get_id_by_line_number(4, 1), 6)
+        xml_orm.change_node_order(1, 4, 1)
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root><e /><c><d /></c></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+        with xml_orm.Session(xml_orm.engine) as session:
+            self.assertEqual(session.query(xml_orm.XmlAttribute).count(), 0)
+        xml_orm.delete_subtree(1, 1)
+        self.assertEqual(xml_orm.available_xml(), [])
+
     def test_get_id_by_line_number(self):
         xml_orm.save_xml('<root><person id="1" name="John"><age>30</age><gender>Male</gender></person><person id="2" name="Jane"><age>25</age><gender>Female</gender></person></root>')
         self.assertEqual(xml_orm.get_id_by_line_number(3, 1), 3)
 
+    def assertLinesConsistent(self, root_id):
+        with xml_orm.Session(xml_orm.engine) as session:
+            nodes = session.query(xml_orm.XmlNodes).filter(xml_orm.XmlNodes.doc_id == root_id).all()
+            expected = xml_orm._preorder_lines(nodes, root_id, 1)
+            self.assertEqual({node.node_id: (node.line, node.last_line) for node in nodes}, expected)
+
+    def test_lines_are_maintained(self):
+        xml = '<root><a><b/><c><d/></c></a><e><f/></e><g/></root>'
+        xml_orm.save_xml(xml)
+        xml_orm.save_xml(xml, bulk=False)
+        xml_orm.save_xml_file(io.BytesIO(xml.encode()))
+        for root_id in (1, 9, 17):
+            self.assertLinesConsistent(root_id)
+        xml_orm.add_sub_xml(1, 2, '<h><i/><j/></h>')
+        xml_orm.add_sub_xml(9, 4, '<h><i/><j/></h>', bulk=False)
+        xml_orm.change_node_order(17, 2, 3)
+        xml_orm.change_node_order(1, 2, 2)
+        for root_id in (1, 9, 17):
+            self.assertLinesConsistent(root_id)
+        loaded = xml_orm.load_xml(1).split('\n')
+        self.assertEqual(xml_orm.get_id_by_line_number(3, 1), 7)
+        self.assertEqual(loaded[3], '<f />')
+
     def test_upadate_node_value(self):
         xml_orm.save_xml('<root><person id="1" name="John"><age>30</age><gender>Male</gender></person><person id="2" name="Jane"><age>25</age><gender>Female</gender></person></root>')
         xml_orm.update_node_value(1, 2, 'id=2')
@@ -50,17 +204,358 @@ class TestXMLMethods(unittest.TestCase):
         loaded = xml_orm.load_xml(1)
         self.assertEqual(xml[0]+add+xml[1], loaded[loaded.find('\n')+1:].replace('\n', ''))
 
+    def test_add_sub_node_orm(self):
+        xml_orm.save_xml('<root><a></a></root>')
+        xml_orm.add_sub_xml(1, 1, '<b x="1"><c>text</c></b>', bulk=False)
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root><a /><b x="1"><c>text</c></b></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+
     def test_change_order(self):
         xml_orm.save_xml('<root><person id="1" name="John"><age>30</age><gender>Male</gender></person><person id="2" name="Jane"><age>25</age><gender>Female</gender></person></root>')
         xml_orm.change_node_order(1, 2, 2)
         expected = '<root><person id="2" name="Jane"><age>25</age><gender>Female</gender></person><person id="1" name="John"><age>30</age><gender>Male</gender></person></root>'
         loaded = xml_orm.load_xml(1)
         self.assertEqual(expected, loaded[loaded.find('\n')+1:].replace('\n', ''))
-    
+
+    def test_positions(self):
+        xml_orm.save_xml('<root><a><x/></a><b/><c/></root>')
+        xml_orm.add_sub_xml(1, 1, '<d><y/></d>', position=1)
+        xml_orm.add_sub_xml(1, 1, '<e/>', position=3, bulk=False)
+        xml_orm.add_sub_xml(1, 1, '<f/>', position=10)
+        xml_orm.add_sub_xml(1, 4, '<z/>', position=1)
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root><d><y /></d><a><z /><x /></a><e /><b /><c /><f /></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+        self.assertLinesConsistent(1)
+        xml_orm.move_node(1, 10, 1)
+        xml_orm.move_node(1, 6, 2)
+        xml_orm.move_node(1, 3, 99)
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root><f /><a><x /><z /></a><e /><b /><c /><d><y /></d></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+        self.assertLinesConsistent(1)
+        for i in range(20): # gap between a and e is used up and children are respaced
+            xml_orm.add_sub_xml(1, 1, f'<g{i}/>', position=3)
+        self.assertEqual(xml_orm.load_xml(1).split('\n')[7:10], ['<g19 />', '<g18 />', '<g17 />'])
+        self.assertLinesConsistent(1)
+        with self.assertRaises(ValueError):
+            xml_orm.move_node(1, 1, 1)
+
+    def test_reorder_many_siblings(self):
+        xml_orm.save_xml('<root>' + '<a><b/></a>' * 3000 + '</root>')
+        with xml_orm.query_budget() as counters: # only rows between old and new place are written
+            xml_orm.move_node(1, 100, 5)
+            xml_orm.change_node_order(1, 2, 2)
+        self.assertLess(counters['rows_written'], 120)
+        started = time.perf_counter()
+        with xml_orm.query_budget(20) as counters: # last child moves before the first one
+            xml_orm.move_node(1, 6000, 1)
+        self.assertLess(counters['rows_written'], 6010)
+        self.assertLess(time.perf_counter() - started, 2)
+        self.assertEqual([child['node_id'] for child in xml_orm.load_children(1, limit=4)], [6000, 4, 2, 6])
+        self.assertEqual(xml_orm.load_children(1, offset=5, limit=1)[0]['node_id'], 100)
+        self.assertLinesConsistent(1)
+        with self.assertRaises(ValueError):
+            xml_orm.add_sub_xml(1, 1, '<h/>', position=0)
+
+    def test_load_children(self):
+        xml_orm.save_xml('<root a="1"><b x="2">text</b><c><d/></c><e/></root>')
+        self.assertEqual(xml_orm.load_node(1), {'node_id': 1, 'line': 1, 'last_line': 5, 'name': 'root', 'attributes': {'a': '1'}, 'text': None, 'has_children': True})
+        self.assertIsNone(xml_orm.load_node(99))
+        children = xml_orm.load_children(1)
+        self.assertEqual([(child['node_id'], child['name'], child['has_children']) for child in children], [(2, 'b', False), (3, 'c', True), (5, 'e', False)])
+        self.assertEqual((children[0]['attributes'], children[0]['text']), ({'x': '2'}, 'text'))
+        self.assertEqual([child['name'] for child in xml_orm.load_children(1, offset=1, limit=1)], ['c'])
+        xml_orm.move_node(1, 5, 1)
+        self.assertEqual([child['line'] for child in xml_orm.load_children(1)], [2, 3, 4])
+        self.assertEqual(xml_orm.get_line_number(4), 5)
+        self.assertIsNone(xml_orm.get_line_number(99))
+
+    def test_load_subtree(self):
+        xml = '<root a="1"><b x="&lt;2&gt;">t&amp;xt</b><c><d><e/></d></c><f>x<g/></f><h></h></root>'
+        xml_orm.save_xml(xml)
+        self.assertEqual(''.join(xml_orm.iter_xml(1, batch_size=2, chunk_size=10)), xml_orm.load_xml(1))
+        self.assertEqual(''.join(xml_orm.iter_xml(1, 3)), '<c>\n<d>\n<e />\n</d>\n</c>')
+        page = xml_orm.load_subtree(1, 1, max_depth=1, limit=2)
+        self.assertEqual(page['xml'], '<root a="1">\n<b x="&lt;2&gt;">t&amp;xt</b>\n<c />\n</root>')
+        self.assertEqual((page['children'], page['truncated']), (2, [3]))
+        page = xml_orm.load_subtree(**page['next'])
+        self.assertEqual(page['xml'], '<root a="1">\n<f>x</f>\n<h />\n</root>')
+        self.assertEqual((page['truncated'], page['next']), ([6], None))
+        self.assertEqual(xml_orm.load_subtree(1, {'node_id': 3}, max_depth=1)['truncated'], [4])
+        self.assertEqual(xml_orm.load_subtree(1, 3)['xml'], xml_orm.query_xml(1, '/root/c')[0])
+        self.assertEqual(xml_orm.load_subtree(1, 1, max_depth=0)['truncated'], [1])
+        with self.assertRaises(ValueError):
+            xml_orm.load_subtree(1, 1, limit=0)
+
+    def test_import_directory(self):
+        documents = ['<a x="1"><b>text</b><c/></a>', '<d><e><f y="2"/></e></d>', '<g>']
+        with tempfile.TemporaryDirectory() as directory:
+            os.mkdir(os.path.join(directory, 'sub'))
+            paths = [os.path.join(directory, name) for name in ('1.xml', '2.xml', os.path.join('sub', '3.xml'))]
+            for path, document in zip(paths, documents):
+                with open(path, 'w') as file:
+                    file.write(document)
+            reported = []
+            result = xml_import.import_directory(directory, workers=2, progress=lambda *args: reported.append(args))
+        self.assertEqual(result['imported'], {paths[0]: 1, paths[1]: 4})
+        self.assertEqual(list(result['errors']), [paths[2]])
+        self.assertEqual([(done, total, root_id) for done, total, _, root_id, _ in reported], [(1, 3, 1), (2, 3, 4), (3, 3, None)])
+        for root_id, document in zip((1, 4), documents):
+            self.assertEqual(xml_orm.load_xml(root_id), xml_orm.load_xml(xml_orm.save_xml(document)))
+        self.assertEqual(xml_orm.load_subtree(4, 3)['xml'], '<f y="2" />')
+
+    def test_import_directory_errors(self):
+        names = ['a.xml', 'b.xml', 'kill.xml', 'locked.xml', 'z.xml']
+        with tempfile.TemporaryDirectory() as directory:
+            for name in names:
+                with open(os.path.join(directory, name), 'w') as file:
+                    file.write(f'<{name[:-4]}><child/></{name[:-4]}>')
+            with unittest.mock.patch.object(xml_import, '_parse_file', killing_parse), unittest.mock.patch.object(xml_import, '_save_rows', failing_save):
+                result = xml_import.import_directory(directory, workers=2)
+        self.assertEqual(sorted(os.path.basename(path) for path in result['imported']), ['a.xml', 'b.xml', 'z.xml'])
+        self.assertEqual({os.path.basename(path): error.split(':')[0] for path, error in result['errors'].items()},
+                         {'kill.xml': 'BrokenProcessPool', 'locked.xml': 'OperationalError'})
+        self.assertEqual([root for root, _ in xml_orm.available_xml()], [1, 3, 5])
+
+    def test_apply_edits(self):
+        xml_orm.save_xml('<root><a x="1"><b>text</b></a><c y="2"/><d/></root>')
+        with xml_orm.query_budget() as counters:
+            with xml_orm.edit(1) as doc:
+                doc.add_sub_xml(1, '<e/>', position=1)
+                doc.update_node_value(3, '__text__=changed')
+                doc.move_node(5, 1)
+                doc.delete_subtree(2)
+                doc.update_node_value(4, 'y=3')
+        self.assertEqual(counters['commits'], 1)
+        loaded = xml_orm.load_xml(1)
+        self.assertEqual('<root><d /><e /><c y="3" /></root>', loaded[loaded.find('\n')+1:].replace('\n', ''))
+        self.assertLinesConsistent(1)
+        with self.assertRaises(ValueError):
+            xml_orm.apply_edits(1, [('update_node_value', 4, 'y=4'), ('delete_subtree', 4), ('update_node_value', 4, 'y=5')])
+        with self.assertRaises(ValueError):
+            xml_orm.apply_edits(1, [('rename', 2, 'x')])
+        self.assertEqual(xml_orm.load_xml(1), loaded)
+
     def test_find(self):
         xml_orm.save_xml('<root><person id="1" name="John"><age>30</age><gender>Male</gender></person><person id="2" name="Jane"><age>25</age><gender>Female</gender></person></root>')
         self.assertEqual(xml_orm.find_node_with_value(1, 1), ['<person id="1" name="John"></person>'])
         self.assertEqual(xml_orm.find_node_with_value(1, 25), ['<age>25</age>'])
 
+    def test_find_is_scoped_to_document(self):
+        xml_orm.save_xml('<root><a>25</a></root>')
+        xml_orm.save_xml('<root><b x="25">25</b><c>25</c><d>26</d></root>')
+        self.assertEqual(xml_orm.find_node_with_value(1, '25'), ['<a>25</a>'])
+        self.assertEqual(xml_orm.find_node_with_value(3, '25'), ['<b x="25">25</b>', '<c>25</c>'])
+        self.assertEqual(xml_orm.find_node_with_value(3, '25', offset=1, limit=1), ['<c>25</c>'])
+
+    def test_find_substring(self):
+        xml_orm.save_xml('<root><a>100%</a><b>1000</b><c>x_y</c></root>')
+        self.assertEqual(xml_orm.find_node_with_value(1, '00', mode='substring'), ['<a>100%</a>', '<b>1000</b>'])
+        self.assertEqual(xml_orm.find_node_with_value(1, '0%', mode='substring'), ['<a>100%</a>'])
+        self.assertEqual(xml_orm.find_node_with_value(1, '_', mode='substring'), ['<c>x_y</c>'])
+
+    def test_find_full_text(self):
+        xml_orm.enable_full_text_search()
+        try:
+            with open('example.xml', 'rb') as file:
+                xml_orm.save_xml(file.read())
+            self.assertEqual(xml_orm.find_node_with_value(1, 'Midnight Rain', mode='fulltext'), ['<title>Midnight Rain</title>'])
+            self.assertEqual(len(xml_orm.find_node_with_value(1, 'zomb*', mode='fulltext')), 1)
+            xml_orm.update_node_value(1, 11, '__text__=Midnight Sun')
+            self.assertEqual(xml_orm.find_node_with_value(1, 'sun', mode='fulltext'), ['<title>Midnight Sun</title>'])
+            xml_orm.delete_subtree(1, 9)
+            self.assertEqual(xml_orm.find_node_with_value(1, 'sun', mode='fulltext'), [])
+        finally:
+            xml_orm.disable_full_text_search()
+
+    def test_query_xml(self):
+        xml_orm.save_xml('<root><person id="1" name="John"><age>30</age><gender>Male</gender></person><person id="2" name="Jane"><age>25</age><gender>Female</gender></person></root>')
+        self.assertEqual(xml_orm.query_xml(1, '/root/person[@name="Jane"]/age'), ['<age>25</age>'])
+        self.assertEqual(xml_orm.query_xml(1, "//person[@id='1']/gender"), ['<gender>Male</gender>'])
+        self.assertEqual(xml_orm.query_xml(1, '//*[text()="Female"]'), ['<gender>Female</gender>'])
+        self.assertEqual(xml_orm.query_xml(1, 'person[2]', subtree=False), ['<person id="2" name="Jane"></person>'])
+        self.assertEqual(xml_orm.query_xml(1, '//person[1]'), ['<person id="1" name="John">\n<age>30</age>\n<gender>Male</gender>\n</person>'])
+        self.assertEqual(xml_orm.query_xml(1, '//age'), ['<age>30</age>', '<age>25</age>'])
+        self.assertEqual(xml_orm.query_xml(1, '/person'), [])
+        with self.assertRaises(ValueError):
+            xml_orm.query_xml(1, '//person[last()]')
+        for xpath in ('//c/..', '/root/.', '//1a'):
+            with self.assertRaises(ValueError):
+                xml_orm.query_xml(1, xpath)
+
+    def test_cache(self):
+        xml_orm.enable_cache(2)
+        try:
+            xml_orm.save_xml('<root><a x="1"/></root>')
+            xml_orm.save_xml('<b/>')
+            xml_orm.save_xml('<c/>')
+            first = xml_orm.load_xml(1)
+            self.assertEqual(xml_orm.load_xml(1), first)
+            self.assertEqual(xml_orm.get_id_by_line_number(2, 1), 2)
+            xml_orm.load_xml(3)
+            xml_orm.load_xml(4)
+            self.assertEqual(xml_orm.cache_stats(), {'size': 2, 'max_size': 2, 'hits': 2, 'misses': 3, 'evictions': 1, 'invalidations': 3})
+            xml_orm.update_node_value(1, 2, 'x=2')
+            self.assertIn('<a x="2" />', xml_orm.load_xml(1))
+            xml_orm.add_sub_xml(1, 1, '<d/>')
+            self.assertEqual(xml_orm.get_id_by_line_number(3, 1), 5)
+            self.assertEqual(xml_orm.cache_stats()['size'], 1) # miss is answered by index, document is not loaded
+            xml_orm.change_node_order(1, 3, 1)
+            self.assertIn('<root>\n<d />', xml_orm.load_xml(1))
+            xml_orm.delete_subtree(1, 2)
+            self.assertNotIn('<d />', xml_orm.load_xml(1))
+            xml_orm.delete_xml(1)
+            with self.assertRaises(ValueError):
+                xml_orm.load_xml(1)
+            xml_orm.drop_data()
+            self.assertEqual(xml_orm.cache_stats()['size'], 0)
+        finally:
+            xml_orm.disable_cache()
+        self.assertIsNone(xml_orm.cache_stats())
+
+    def test_stats(self):
+        self.clear_names()
+        xml_orm.enable_stats()
+        try:
+            xml_orm.save_xml('<root><a x="1">text</a><b/></root>')
+            xml_orm.load_xml(1)
+            xml_orm.load_xml(1)
+            xml_orm.update_node_value(1, 2, 'x=2')
+            stats = xml_orm.operation_stats(reset=True)
+            self.assertEqual(stats['xml_orm.load_xml']['calls'], 2)
+            self.assertEqual(stats['xml_orm.load_xml']['rows_read'], 2 * 5)
+            self.assertEqual(stats['xml_orm.load_xml']['commits'], 0)
+            self.assertEqual(stats['xml_orm.save_xml']['rows_written'], 7 + 5) # root row is inserted and updated, 5 names are interned
+            self.assertEqual(stats['xml_orm.update_node_value']['rows_written'], 1)
+            self.assertEqual(stats['xml_orm.update_node_value']['commits'], 1)
+            self.assertEqual(xml_orm.operation_stats(), {})
+        finally:
+            xml_orm.disable_stats()
+        self.assertEqual(xml_orm.operation_stats(), {})
+        with xml_orm.query_budget(3) as counters:
+            xml_orm.load_xml(1)
+        self.assertEqual(counters['statements'], 3)
+        with self.assertRaises(AssertionError):
+            with xml_orm.query_budget(5):
+                xml_orm.load_xml(1)
+                xml_orm.load_xml(1)
+
+class TestConcurrency(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.directory = tempfile.TemporaryDirectory()
+        xml_orm.configure(url=f'sqlite:///{os.path.join(self.directory.name, "concurrency.db")}')
+
+    @classmethod
+    def tearDownClass(self):
+        xml_orm.configure(url='sqlite:///XML-database.db')
+        self.directory.cleanup()
+
+    def test_configure(self):
+        with xml_orm.get_engine().connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 30000)
+        with self.assertRaises(TypeError):
+            xml_orm.configure(journal='WAL')
+        with self.assertRaises(ValueError): # node ids are assigned by SQLite write lock
+            xml_orm.configure(url='postgresql://localhost/xml')
+        self.assertTrue(xml_orm._settings['url'].startswith('sqlite'))
+
+    def test_readers_with_writer(self):
+        xml = lambda i: f'<root n="{i}">' + ''.join(f'<item id="{j}"><value>{j}</value></item>' for j in range(200)) + '</root>'
+        xml_orm.save_xml(xml(0))
+        writing, errors = threading.Event(), []
+
+        def writer():
+            try:
+                for i in range(1, 10):
+                    root_id = xml_orm.save_xml(xml(i))
+                    xml_orm.update_node_value(root_id, 2, 'id=changed')
+                    xml_orm.add_sub_xml(root_id, 1, '<item id="200"><value>200</value></item>')
+                    xml_orm.delete_subtree(root_id, 4)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                writing.set()
+
+        def reader():
+            try:
+                while not writing.is_set():
+                    for root_id, _ in xml_orm.available_xml():
+                        root = xml_orm.ElementTree.fromstring(xml_orm.load_xml(root_id).encode())
+                        self.assertIn(len(root), (200, 201)) # states between the committed edits
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(xml_orm.available_xml()), 10)
+
+    def test_reader_process_with_writer(self):
+        root_id = xml_orm.save_xml('<root><a>committed</a></root>')
+        url = xml_orm._settings['url']
+        script = f"import xml_orm; xml_orm.configure(url={url!r}, busy_timeout=1); print(xml_orm.load_xml({root_id}))"
+        with xml_orm.get_engine(write=True).begin() as connection: # write lock is held by this process
+            connection.execute(xml_orm.update(xml_orm.XmlNodes).values(order=xml_orm.XmlNodes.order))
+            reader = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(xml_orm.__file__)))
+        xml = xml_orm.load_xml(root_id)
+        xml_orm.delete_xml(root_id)
+        self.assertEqual(reader.returncode, 0, reader.stderr)
+        self.assertEqual(reader.stdout, xml + '\n')
+
+class TestAsync(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.directory = tempfile.TemporaryDirectory()
+        xml_orm.configure(url=f'sqlite:///{os.path.join(self.directory.name, "async.db")}')
+
+    @classmethod
+    def tearDownClass(self):
+        xml_orm.configure(url='sqlite:///XML-database.db')
+        self.directory.cleanup()
+
+    def run_async(self, coroutine):
+        async def run():
+            try:
+                await xml_orm_async.drop_data()
+                return await coroutine()
+            finally:
+                await xml_orm_async.dispose()
+        return asyncio.run(run())
+
+    def test_save_load_edit(self):
+        async def body():
+            root_id = await xml_orm_async.save_xml('<root><person id="1"><age>30</age></person><person id="2"><age>25</age></person></root>')
+            await xml_orm_async.update_node_value(root_id, 2, 'id=3')
+            await xml_orm_async.add_sub_xml(root_id, 1, '<person id="4"/>')
+            await xml_orm_async.change_node_order(root_id, 6, 1)
+            await xml_orm_async.delete_subtree(root_id, 3)
+            self.assertEqual(await xml_orm_async.available_xml(), [(root_id, 'root')])
+            self.assertEqual(await xml_orm_async.get_id_by_line_number(2, root_id), 6)
+            self.assertEqual(await xml_orm_async.find_node_with_value(root_id, '3'), ['<person id="3"></person>'])
+            self.assertEqual(await xml_orm_async.query_xml(root_id, '//age'), ['<age>30</age>'])
+            xml = await xml_orm_async.load_xml(root_id)
+            self.assertEqual(''.join([chunk async for chunk in xml_orm_async.iter_xml(root_id, batch_size=2, chunk_size=10)]), xml)
+            self.assertEqual((await xml_orm_async.load_subtree(root_id, 3))['xml'], '<person id="3">\n<age>30</age>\n</person>')
+            self.assertEqual([child['line'] for child in await xml_orm_async.load_children(root_id)], [2, 3])
+            self.assertEqual((await xml_orm_async.load_node(root_id + 1))['attributes'], {'id': '3'})
+            self.assertEqual(await xml_orm_async.get_line_number(root_id + 1), 3)
+            return xml
+        self.assertEqual(self.run_async(body).split('\n')[1:], ['<root>', '<person id="4" />', '<person id="3">', '<age>30</age>', '</person>', '</root>'])
+
+    def test_concurrent_reads(self):
+        async def body():
+            root_id = await xml_orm_async.save_xml('<root>' + '<item>value</item>' * 100 + '</root>')
+            expected = xml_orm.load_xml(root_id)
+            loaded = await asyncio.gather(*[xml_orm_async.load_xml(root_id) for _ in range(20)], xml_orm_async.save_xml('<other/>'))
+            self.assertEqual(loaded[:-1], [expected] * 20)
+            await xml_orm_async.delete_xml(root_id)
+            return await xml_orm_async.available_xml()
+        self.assertEqual([name for _, name in self.run_async(body)], ['other'])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file